@@ -0,0 +1,280 @@
+import contextlib
+import hmac
+import logging
+import math
+from datetime import datetime
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+from code_index import REDEEMED, UNKNOWN_CODE
+from codegen import has_valid_check_character
+from config import (
+    API_JOURNAL_PATH, JOURNAL_PATH, get_secret, get_storage_backend, open_code_index, open_client_throttle,
+    open_storage
+)
+from export import EXPORT_FORMATS, iter_export
+from metrics import metrics
+
+API_HOST = '0.0.0.0'
+API_PORT = 8000
+
+# Values of the export endpoint's status parameter
+EXPORT_STATUSES = {'all': None, 'available': False, 'redeemed': True}
+
+# Seconds an idle keep-alive connection is held open - longer than the 60
+# seconds most load balancers and POS HTTP clients keep theirs
+KEEP_ALIVE_TIMEOUT = 75
+
+logger = logging.getLogger(__name__)
+
+
+def open_api_storage(index):
+    """Open the storage backend selected in secrets, as the Streamlit app does
+
+    A journal confirms redemptions before they reach the sheet, so two
+    processes journaling the same code would both confirm it. Unless the
+    API and the app claim redemptions through a shared change log, the API
+    refuses to start while the app journals, and never journals itself.
+    """
+    backend = get_storage_backend()
+    if backend != "sheets":
+        return open_storage(backend, index)
+    if index.change_log is None:
+        if get_secret("journal_path", JOURNAL_PATH):
+            raise RuntimeError(
+                "The API needs shared_cache_path set while the app journals redemptions (journal_path), "
+                "or both could confirm the same code"
+            )
+        # Every redemption is checked against the sheet right before it is written
+        return open_storage(backend, index)
+    # The journal belongs to one process, so the API keeps its own
+    return open_storage(backend, index, journal_path=get_secret("api_journal_path", API_JOURNAL_PATH))
+
+
+def normalize_code(code):
+    """Match codes the way the Check Code tab does"""
+    return str(code).strip().upper()
+
+
+def create_app(storage=None, index=None, api_token=None, throttle=None):
+    """Build the JSON API over storage and index, opening both from secrets if not given
+
+    Codes are answered from the in-memory index, so checks never wait on
+    storage once it is loaded. Redemptions go through CodeIndex.redeem() in
+    a worker thread, like a click on Redeem Code in the app. Without an
+    api_token, checks and redemptions are throttled per client IP address.
+    """
+    if index is None:
+        index = open_code_index()
+    if storage is None:
+        storage = open_api_storage(index)
+    if api_token is None:
+        api_token = get_secret("api_token")
+    if throttle is None:
+        throttle = open_client_throttle()
+    throttle_by_ip = get_secret("throttle_by_ip", True)
+    metrics.enabled = bool(get_secret("metrics_enabled", False))
+
+    def load_codes():
+        return index.get_codes(storage.load_codes, syncer=storage.sync_codes)
+
+    async def current_codes():
+        # Once loaded, stale codes are refreshed in the background, so only
+        # the very first lookup has to wait for storage
+        if index.loaded:
+            return load_codes()
+        return await run_in_threadpool(load_codes)
+
+    def is_authorized(request):
+        if not api_token:
+            return True
+        supplied = request.headers.get('authorization', '')
+        return hmac.compare_digest(supplied.encode(), f"Bearer {api_token}".encode())
+
+    def error(status_code, message, headers=None):
+        return JSONResponse({'error': message}, status_code=status_code, headers=headers)
+
+    def refuse_admin(request):
+        # Exports, stats and metrics reveal every code, so they are never open
+        if not api_token:
+            return error(403, "Set api_token to use this endpoint")
+        if not is_authorized(request):
+            return error(401, "Missing or invalid API token")
+        return None
+
+    def client_keys(request):
+        # Terminals holding the token are trusted, and many may share one
+        # NAT address. Behind a proxy every client may too, so this can be
+        # turned off like the app's.
+        if api_token or not throttle_by_ip or request.client is None:
+            return []
+        return [f"ip:{request.client.host}"]
+
+    def throttled(request):
+        wait = throttle.check(*client_keys(request))
+        if not wait:
+            return None
+        metrics.count('code_attempts_throttled')
+        return error(429, "Too many attempts", headers={'Retry-After': str(math.ceil(wait))})
+
+    def invalid_code(request):
+        metrics.count('code_attempts_rejected')
+        throttle.reject(*client_keys(request))
+        return error(404, "Invalid code")
+
+    async def check_code(request):
+        if not is_authorized(request):
+            return error(401, "Missing or invalid API token")
+        refused = throttled(request)
+        if refused is not None:
+            return refused
+        code = normalize_code(request.path_params['code'])
+        if not has_valid_check_character(code):
+            # A typo - rejected without looking the code up
+            return invalid_code(request)
+        try:
+            with metrics.timer('api.check_code'):
+                codes = await current_codes()
+        except Exception as e:
+            return error(503, f"Error loading codes: {str(e)}")
+        record = codes.get(code)
+        if record is None:
+            return invalid_code(request)
+        return JSONResponse(record)
+
+    async def redeem(request):
+        if not is_authorized(request):
+            return error(401, "Missing or invalid API token")
+        refused = throttled(request)
+        if refused is not None:
+            return refused
+        code = normalize_code(request.path_params['code'])
+        if not has_valid_check_character(code):
+            # A typo - rejected without looking the code up
+            return invalid_code(request)
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            with metrics.timer('api.redeem'):
+                if not index.loaded:
+                    await run_in_threadpool(load_codes)
+                outcome = await run_in_threadpool(index.redeem, storage, code, timestamp)
+        except Exception as e:
+            return error(503, f"Error redeeming code: {str(e)}")
+        if outcome == UNKNOWN_CODE:
+            return invalid_code(request)
+
+        body = dict(index.codes.get(code) or {'code': code})
+        body['outcome'] = outcome
+        return JSONResponse(body, status_code=200 if outcome == REDEEMED else 409)
+
+    async def export(request):
+        refused = refuse_admin(request)
+        if refused is not None:
+            return refused
+        params = request.query_params
+        export_format = params.get('format', 'csv')
+        status = params.get('status', 'all')
+        if export_format not in EXPORT_FORMATS:
+            return error(400, f"format must be one of {', '.join(EXPORT_FORMATS)}")
+        if status not in EXPORT_STATUSES:
+            return error(400, f"status must be one of {', '.join(EXPORT_STATUSES)}")
+        try:
+            codes = await current_codes()
+        except Exception as e:
+            return error(503, f"Error loading codes: {str(e)}")
+
+        mime, extension = EXPORT_FORMATS[export_format]
+        chunks = iter_export(
+            codes,
+            export_format,
+            redeemed=EXPORT_STATUSES[status],
+            deal=params.get('deal'),
+            search=params.get('search', '').strip().upper()
+        )
+        return StreamingResponse(
+            chunks,
+            media_type=mime,
+            headers={'Content-Disposition': f'attachment; filename="codes.{extension}"'}
+        )
+
+    async def stats(request):
+        refused = refuse_admin(request)
+        if refused is not None:
+            return refused
+        try:
+            codes = await current_codes()
+        except Exception as e:
+            return error(503, f"Error loading codes: {str(e)}")
+        code_stats = codes.stats()
+        return JSONResponse({
+            'total': code_stats.total,
+            'available': code_stats.available,
+            'redeemed': code_stats.redeemed,
+            'deals': [
+                {'deal': deal, 'total': total, 'available': available, 'redeemed': redeemed}
+                for deal, total, available, redeemed in code_stats.by_deal()
+            ]
+        })
+
+    async def metrics_dump(request):
+        refused = refuse_admin(request)
+        if refused is not None:
+            return refused
+        if request.query_params.get('format') == 'json':
+            return JSONResponse(metrics.snapshot())
+        return PlainTextResponse(metrics.to_prometheus(), media_type='text/plain; version=0.0.4')
+
+    async def health(request):
+        body = {
+            'loaded': index.loaded,
+            'degraded': index.is_degraded(),
+            'last_error': index.last_error,
+            'codes': len(index.codes)
+        }
+        journal = getattr(storage, 'journal', None)
+        if journal is not None:
+            body['journal'] = {
+                'pending': len(journal),
+                'flushed': storage.flushed,
+                'dropped': storage.dropped,
+                'last_error': storage.last_flush_error
+            }
+        return JSONResponse(body)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        # Load codes before the first terminal asks for one
+        try:
+            await run_in_threadpool(load_codes)
+        except Exception as e:
+            logger.warning("Failed to load codes at startup: %s", e)
+        yield
+        close = getattr(storage, 'close', None)
+        if close is not None:
+            # Write any journaled redemptions before exiting
+            await run_in_threadpool(close)
+
+    return Starlette(
+        routes=[
+            Route('/codes/{code}', check_code, methods=['GET']),
+            Route('/codes/{code}/redeem', redeem, methods=['POST']),
+            Route('/export', export, methods=['GET']),
+            Route('/stats', stats, methods=['GET']),
+            Route('/metrics', metrics_dump, methods=['GET']),
+            Route('/health', health, methods=['GET'])
+        ],
+        lifespan=lifespan
+    )
+
+
+if __name__ == '__main__':
+    uvicorn.run(
+        create_app(),
+        host=get_secret("api_host", API_HOST),
+        port=int(get_secret("api_port", API_PORT)),
+        timeout_keep_alive=KEEP_ALIVE_TIMEOUT
+    )
@@ -1,15 +1,39 @@
+import csv
+import io
+import math
+import time
+import uuid
 import streamlit as st
-import gspread
-from google.oauth2.service_account import Credentials
-import random
-import string
-from datetime import datetime
-
-# Configuration
-SCOPES = [
-    'https://www.googleapis.com/auth/spreadsheets',
-    'https://www.googleapis.com/auth/drive'
-]
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+from code_index import REDEEMED, ALREADY_REDEEMED, UNKNOWN_CODE, APPLIED, UNCHANGED
+from code_store import CompactCodeStore
+from storage import FakeWorksheet
+from sheets_scheduler import SheetsScheduler
+from snapshot import CodeSnapshot, SnapshotError
+from export import EXPORT_FORMATS, iter_export
+from metrics import metrics
+from codegen import iter_unique_code_chunks, iter_allocated_code_chunks, has_valid_check_character
+from config import (
+    ARCHIVE_SHEET, JOURNAL_PATH, get_secret, get_storage_backend, open_code_index, open_client_throttle,
+    open_code_permutation, open_sheets_connection, open_storage
+)
+
+# Timed to the end of the script as the page_render operation
+page_started = time.perf_counter()
+
+# Configuration - settings shared with the API live in config.py
+
+# Days of hourly redemptions charted under Deal Statistics
+REDEMPTION_CHART_DAYS = 7
+
+# Rows per page offered for the admin code grid
+PAGE_SIZE_OPTIONS = [50, 100, 500, 1000, 5000]
+
+# Largest batch an admin can generate, and codes sent per sheet write -
+# 10,000 rows x 4 columns keeps each request well under Sheets' payload limits
+MAX_CODES_PER_RUN = 1_000_000
+CODES_PER_WRITE = 10_000
 
 # Get admin password from Streamlit secrets
 try:
@@ -21,128 +45,155 @@ except:
 # Initialize session state
 if 'authenticated' not in st.session_state:
     st.session_state.authenticated = False
-if 'sheet' not in st.session_state:
-    st.session_state.sheet = None
 
 # Helper functions
-def connect_to_sheet():
-    """Connect to Google Sheets"""
+@st.cache_resource
+def get_code_index():
+    """Code index shared by every session in this process"""
+    return open_code_index()
+
+@st.cache_resource
+def get_metrics():
+    """Process-wide performance metrics, collected from startup if metrics_enabled is set"""
+    metrics.enabled = bool(get_secret("metrics_enabled", False))
+    return metrics
+
+@st.cache_resource
+def get_client_throttle():
+    """Limits on code checks and redemptions per session and IP address, shared by every session"""
+    return open_client_throttle()
+
+@st.cache_resource
+def get_code_permutation():
+    """Keyed permutation for allocating codes, or None to generate them at random"""
+    return open_code_permutation()
+
+@st.cache_resource
+def get_memory_worksheet():
+    """In-memory worksheet shared by every session in this process"""
+    return FakeWorksheet()
+
+@st.cache_resource
+def get_memory_counter_worksheet():
+    """In-memory allocator counter shared by every session in this process"""
+    return FakeWorksheet()
+
+@st.cache_resource
+def get_memory_archive_worksheet():
+    """In-memory archive of retired codes shared by every session in this process"""
+    return FakeWorksheet()
+
+@st.cache_resource
+def get_sheets_connection():
+    """Google Sheets connection shared by every session, opened on first use"""
+    return open_sheets_connection(allocator=get_code_permutation() is not None)
+
+@st.cache_resource
+def get_sheets_scheduler():
+    """Rate limiter and retry/coalescing gate for every Google Sheets call"""
+    # Rejected credentials reopen the connection on the next request
+    return SheetsScheduler(on_auth_error=get_sheets_connection().reset)
+
+@st.cache_resource
+def get_shared_storage(backend):
+    """Storage backend shared by every session in this process"""
+    if backend == "memory":
+        return open_storage(backend, get_code_index(), memory_worksheets=(
+            get_memory_worksheet(), get_memory_counter_worksheet(), get_memory_archive_worksheet()
+        ))
+    if backend != "sheets":
+        return open_storage(backend, get_code_index())
+    return open_storage(
+        backend,
+        get_code_index(),
+        journal_path=get_secret("journal_path", JOURNAL_PATH),
+        connection=get_sheets_connection(),
+        scheduler=get_sheets_scheduler()
+    )
+
+@metrics.instrument()
+def connect_to_storage():
+    """Get the storage backend selected in secrets"""
+    backend = get_storage_backend()
     try:
-        # Get credentials from Streamlit secrets
-        creds_dict = st.secrets["gcp_service_account"]
-        creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
-        client = gspread.authorize(creds)
-        
-        # Open the spreadsheet (you can use sheet URL or name)
-        spreadsheet_url = st.secrets["spreadsheet_url"]
-        sheet = client.open_by_url(spreadsheet_url).sheet1
-        
-        # Initialize headers if empty - don't modify existing sheets
-        headers = sheet.row_values(1)
-        if not headers or not any(headers):
-            sheet.update('A1:D1', [['Code', 'Deal', 'Redeemed', 'Redeemed At']])
-        
-        return sheet
+        return get_shared_storage(backend)
     except Exception as e:
-        st.error(f"Error connecting to Google Sheets: {str(e)}")
+        st.error(f"Error opening {backend} storage: {str(e)}")
         return None
 
-def load_codes(sheet):
-    """Load all codes from Google Sheets"""
+@st.cache_resource
+def get_code_snapshot():
+    """Local snapshot of the code table for fast start-up, or None if disabled"""
+    path = get_secret("snapshot_path", "codes.snapshot")
+    if not path or get_storage_backend() != "sheets":
+        return None
+    return CodeSnapshot(path)
+
+@metrics.instrument()
+def restore_code_snapshot(storage, snapshot):
+    """Serve codes from the local snapshot until they are synced with storage"""
     try:
-        all_values = sheet.get_all_values()
-        if len(all_values) < 2:
-            return {}
-        
-        # Get headers from first row and clean them
-        headers = [str(h).strip() for h in all_values[0]]
-        
-        # Find column indices - search for headers case-insensitively
-        code_idx = None
-        deal_idx = None
-        redeemed_idx = None
-        redeemed_at_idx = None
-        
-        for i, header in enumerate(headers):
-            header_lower = header.lower()
-            if header_lower == 'code':
-                code_idx = i
-            elif header_lower == 'deal':
-                deal_idx = i
-            elif header_lower == 'redeemed':
-                redeemed_idx = i
-            elif 'redeem' in header_lower and 'at' in header_lower:
-                redeemed_at_idx = i
-        
-        # Fallback to positional if headers not found
-        if code_idx is None:
-            code_idx = 0
-        if deal_idx is None:
-            deal_idx = 1
-        if redeemed_idx is None:
-            redeemed_idx = 2
-        if redeemed_at_idx is None:
-            redeemed_at_idx = 3
-        
-        codes = {}
-        # Process data rows (skip header)
-        for row in all_values[1:]:
-            # Skip empty rows
-            if not row or not any(row):
-                continue
-                
-            if len(row) > code_idx and row[code_idx]:
-                code = str(row[code_idx]).strip()
-                deal = str(row[deal_idx]).strip() if len(row) > deal_idx and row[deal_idx] else ''
-                redeemed_value = row[redeemed_idx] if len(row) > redeemed_idx else False
-                redeemed_at = str(row[redeemed_at_idx]).strip() if len(row) > redeemed_at_idx and row[redeemed_at_idx] else ''
-                
-                # Handle different types for Redeemed field
-                if isinstance(redeemed_value, str):
-                    redeemed_str = redeemed_value.strip().upper()
-                    redeemed = redeemed_str == 'TRUE'
-                elif isinstance(redeemed_value, bool):
-                    redeemed = redeemed_value
-                else:
-                    redeemed = False
-                
-                codes[code] = {
-                    'code': code,
-                    'deal': deal,
-                    'redeemed': redeemed,
-                    'redeemed_at': redeemed_at
-                }
-        return codes
-    except Exception as e:
-        st.error(f"Error loading codes: {str(e)}")
-        return {}
+        codes, sync_state = snapshot.load()
+    except SnapshotError:
+        return False
+    
+    def on_restore():
+        storage.restore_sync_state(sync_state)
+        # Redemptions still waiting in the journal aren't in the snapshot
+        apply_pending = getattr(storage, 'apply_pending', None)
+        if apply_pending is not None:
+            apply_pending(codes)
+    
+    return get_code_index().restore(codes, on_restore)
 
-def save_code(sheet, code, deal='', redeemed=False, redeemed_at=''):
-    """Add a new code to Google Sheets"""
+@metrics.instrument()
+def get_degraded_message(storage):
+    """Explain why the app is running in degraded mode, or None if it isn't"""
+    index = get_code_index()
+    journaled = getattr(storage, 'journal', None) is not None
+    if index.is_degraded():
+        loaded = datetime.fromtimestamp(index.refreshed_at).strftime("%Y-%m-%d %H:%M") if index.refreshed_at else "startup"
+        message = f"Storage can't be reached, so codes are checked against the copy loaded at {loaded}."
+    elif getattr(storage, 'last_flush_error', None):
+        message = "Redemptions can't be written to the sheet right now."
+    else:
+        return None
+    if journaled:
+        message += " Redemptions are saved on this server and written to the sheet once it is back."
+    return message
+
+@metrics.instrument()
+def get_codes(storage, force=False):
+    """Get all codes from the shared index, loading them from storage when stale"""
     try:
-        # Convert boolean to string for consistent storage
-        sheet.append_row([str(code), str(deal), str(redeemed), str(redeemed_at)])
-        return True
+        index = get_code_index()
+        snapshot = get_code_snapshot()
+        if snapshot is not None and not index.loaded and not force:
+            # Start from the snapshot - the first get_codes() below then syncs in the background
+            restore_code_snapshot(storage, snapshot)
+        if index.is_fresh() and not force:
+            metrics.count('code_cache_hits')
+        elif index.loaded and not force:
+            # Served straight away while a background refresh runs
+            metrics.count('code_cache_stale_hits')
+        else:
+            metrics.count('code_cache_misses')
+        codes = index.get_codes(storage.load_codes, force=force, syncer=storage.sync_codes)
+        if snapshot is not None:
+            snapshot.save_if_due(index, storage)
+        return codes
     except Exception as e:
-        st.error(f"Error saving code: {str(e)}")
-        return False
+        st.error(f"Error loading codes: {str(e)}")
+        return CompactCodeStore()
 
-def save_codes_batch(sheet, codes_list, deal=''):
-    """Add multiple codes to Google Sheets"""
+@metrics.instrument()
+def save_codes_batch(storage, codes_list, deal=''):
+    """Add multiple codes to storage"""
     try:
-        # Get the current number of rows with data in column A
-        col_a_values = sheet.col_values(1)  # Get all values in column A
-        next_row = len(col_a_values) + 1
-        
-        # Prepare rows for batch insert - use 'FALSE' in uppercase for consistency
-        rows = [[str(code), str(deal), 'FALSE', ''] for code in codes_list]
+        storage.save_codes_batch(codes_list, deal)
         
-        # Update specific range A:D starting at next_row
-        end_row = next_row + len(rows) - 1
-        range_notation = f'A{next_row}:D{end_row}'
-        
-        # Use named arguments to avoid deprecation warning
-        sheet.update(values=rows, range_name=range_notation, value_input_option='USER_ENTERED')
+        # Keep the shared index in step with what we just wrote
+        get_code_index().add_codes(codes_list, deal)
         
         return True
     except Exception as e:
@@ -151,65 +202,151 @@ def save_codes_batch(sheet, codes_list, deal=''):
         st.error(f"Traceback: {traceback.format_exc()}")
         return False
 
-def update_code_status(sheet, code, redeemed=True):
-    """Update code redemption status"""
+@metrics.instrument()
+def bulk_update_code_status(storage, codes_list, redeemed=True):
+    """Set the status of many codes in one batched write, returning code -> outcome"""
     try:
-        # Get all values to find the exact row
-        all_values = sheet.get_all_values()
-        
-        # Find the row with this code in column A (index 0)
-        target_row = None
-        for row_idx, row in enumerate(all_values):
-            if len(row) > 0 and str(row[0]).strip() == str(code).strip():
-                target_row = row_idx + 1  # Sheets are 1-indexed
-                break
+        index = get_code_index()
+        codes_list = sorted({str(code).strip() for code in codes_list if str(code).strip()})
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S") if redeemed else ''
         
-        if target_row is None:
-            return False
-        
-        # Update column C (index 3) with redeemed status
-        redeemed_str = 'TRUE' if redeemed else 'FALSE'
-        sheet.update_cell(target_row, 3, redeemed_str)
-        
-        # Update column D (index 4) with timestamp or clear it
-        if redeemed:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            sheet.update_cell(target_row, 4, timestamp)
+        with ExitStack() as stack:
+            # Take the code locks in a fixed order so two bulk updates can't deadlock
+            for lock in index.locks_for(codes_list):
+                stack.enter_context(lock)
+            
+            codes = index.get_codes(storage.load_codes, syncer=storage.sync_codes)
+            results = {}
+            pending = []
+            for code in codes_list:
+                if code in codes and codes[code]['redeemed'] == redeemed:
+                    results[code] = UNCHANGED
+                else:
+                    pending.append(code)
+            
+            found = storage.update_codes_status(pending, redeemed, timestamp, verify_rows=not index.is_fresh()) if pending else set()
+            for code in pending:
+                if code in found:
+                    index.set_status(code, redeemed, timestamp)
+                    results[code] = APPLIED
+                else:
+                    results[code] = UNKNOWN_CODE
+        return results
+    except Exception as e:
+        st.error(f"Error updating codes: {str(e)}")
+        return None
+
+@metrics.instrument()
+def parse_code_list(text):
+    """Read codes from pasted text or CSV, taking the first column and skipping a header"""
+    codes_list = []
+    for row in csv.reader(io.StringIO(text)):
+        # Pasted codes may also be separated by spaces or tabs
+        cells = row[0].split() if len(row) == 1 else row[:1]
+        for cell in cells:
+            code = cell.strip().upper()
+            if code and code != "CODE":
+                codes_list.append(code)
+    return codes_list
+
+@metrics.instrument()
+def build_export(codes, export_format, **filters):
+    """Build an export as bytes - the whole file is held in memory until it is downloaded"""
+    return b''.join(chunk.encode() for chunk in iter_export(codes, export_format, **filters))
+
+def get_client_keys():
+    """Throttle keys for the current visitor - their session and, when known, their IP address"""
+    if 'client_id' not in st.session_state:
+        st.session_state.client_id = uuid.uuid4().hex
+    keys = [f"session:{st.session_state.client_id}"]
+    # Behind a proxy every visitor may share one address, so this can be turned off
+    if get_secret("throttle_by_ip", True) and st.context.ip_address:
+        keys.append(f"ip:{st.context.ip_address}")
+    return keys
+
+@metrics.instrument()
+def allow_code_attempt():
+    """Take a check or redemption from the visitor's allowance, showing an error once it's used up"""
+    wait = get_client_throttle().check(*get_client_keys())
+    if wait:
+        metrics.count('code_attempts_throttled')
+        st.error(f"⏳ Too many attempts. Please wait {math.ceil(wait)} seconds and try again.")
+        return False
+    return True
+
+@metrics.instrument()
+def reject_code_attempt():
+    """Charge the visitor for trying a code that doesn't exist"""
+    metrics.count('code_attempts_rejected')
+    get_client_throttle().reject(*get_client_keys())
+
+@metrics.instrument()
+def redeem_code(storage, code):
+    """Redeem a code only if it is not already redeemed, returning the outcome"""
+    try:
+        code = str(code).strip()
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return get_code_index().redeem(storage, code, timestamp)
+    except Exception as e:
+        st.error(f"Error redeeming code: {str(e)}")
+        return None
+
+@metrics.instrument()
+def generate_and_save_codes(storage, num_codes, deal='', on_progress=None):
+    """Generate unique codes and stream them to storage in chunks, returning how many were saved"""
+    saved_codes = []
+    try:
+        permutation = get_code_permutation()
+        # New codes end in a check character so typos are caught before any lookup
+        checked = bool(get_secret("check_characters", False))
+        if permutation is not None:
+            # Unique by construction, so existing codes are not loaded first.
+            # Whatever the index already holds guards against legacy random codes.
+            chunks = iter_allocated_code_chunks(
+                permutation, storage.reserve_code_indices, num_codes, CODES_PER_WRITE, get_code_index().codes, checked
+            )
         else:
-            sheet.update_cell(target_row, 4, '')
+            existing_codes = get_codes(storage).keys()
+            chunks = iter_unique_code_chunks(num_codes, existing_codes, CODES_PER_WRITE, checked)
         
-        return True
+        for chunk in chunks:
+            storage.save_codes_batch(chunk, deal)
+            saved_codes.extend(chunk)
+            if on_progress:
+                on_progress(len(saved_codes))
     except Exception as e:
-        st.error(f"Error updating code: {str(e)}")
-        return False
+        st.error(f"Error saving codes: {str(e)}")
+    finally:
+        # Index every chunk that reached storage, even if a later one failed
+        if saved_codes:
+            get_code_index().add_codes(saved_codes, deal)
+    return len(saved_codes)
 
-def generate_code():
-    """Generate a random 8-character alphanumeric code in format XXXX-XXXX"""
-    part1 = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
-    part2 = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
-    return f"{part1}-{part2}"
-
-def generate_unique_codes(num_codes, existing_codes):
-    """Generate unique codes that don't already exist"""
-    new_codes = []
-    attempts = 0
-    max_attempts = num_codes * 100
-    
-    while len(new_codes) < num_codes and attempts < max_attempts:
-        attempts += 1
-        code = generate_code()
-        if code not in existing_codes and code not in new_codes:
-            new_codes.append(code)
-    
-    return new_codes
+@metrics.instrument()
+def delete_deal_codes(storage, deal, archive=True):
+    """Delete every code of a deal, archiving them first if asked, returning how many were deleted"""
+    try:
+        index = get_code_index()
+        codes = index.get_codes(storage.load_codes, syncer=storage.sync_codes)
+        codes_list = [
+            code for page in codes.query_index().query(deal=deal).iter_pages(CODES_PER_WRITE) for code, _ in page
+        ]
+        deleted = storage.delete_codes(codes_list, archive)
+        
+        # Drop them from the shared index too, so nothing needs reloading
+        index.remove_codes(deleted)
+        
+        return len(deleted)
+    except Exception as e:
+        st.error(f"Error deleting codes: {str(e)}")
+        return None
 
-def delete_all_codes(sheet):
-    """Delete all codes from sheet (except header)"""
+@metrics.instrument()
+def delete_all_codes(storage):
+    """Delete all codes from storage"""
     try:
-        # Delete all rows except the header
-        num_rows = len(sheet.get_all_values())
-        if num_rows > 1:
-            sheet.delete_rows(2, num_rows)
+        storage.delete_all_codes()
+        get_code_index().clear()
         return True
     except Exception as e:
         st.error(f"Error deleting codes: {str(e)}")
@@ -233,22 +370,6 @@ st.markdown("""
         border-radius: 10px;
         margin-bottom: 2rem;
     }
-    .code-box {
-        padding: 1rem;
-        border-radius: 8px;
-        border: 2px solid #e0e0e0;
-        margin: 0.5rem 0;
-    }
-    .code-redeemed {
-        background-color: #f5f5f5;
-        border-color: #d0d0d0;
-        color: #666;
-    }
-    .code-available {
-        background-color: #e8f5e9;
-        border-color: #4caf50;
-        color: #2e7d32;
-    }
     .deal-info {
         background-color: #e3f2fd;
         border-left: 4px solid #2196f3;
@@ -267,15 +388,14 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-# Connect to Google Sheets
-if st.session_state.sheet is None:
-    with st.spinner("Connecting to Google Sheets..."):
-        st.session_state.sheet = connect_to_sheet()
+get_metrics()
 
-sheet = st.session_state.sheet
+# Shared storage (Google Sheets unless configured otherwise) - opening it
+# doesn't touch the network, so the page renders straight away
+storage = connect_to_storage()
 
-if sheet is None:
-    st.error("❌ Unable to connect to Google Sheets. Please check your configuration.")
+if storage is None:
+    st.error("❌ Unable to connect to storage. Please check your configuration.")
     st.stop()
 
 # Header
@@ -286,6 +406,10 @@ st.markdown("""
     </div>
 """, unsafe_allow_html=True)
 
+degraded_message = get_degraded_message(storage)
+if degraded_message:
+    st.warning(f"⚠️ **Offline mode** - {degraded_message}")
+
 # Tab selection
 tab1, tab2 = st.tabs(["🔍 Check Code", "⚙️ Admin"])
 
@@ -295,63 +419,48 @@ with tab1:
     
     code_input = st.text_input(
         "Enter your discount code:",
-        max_chars=9,
-        placeholder="XXXX-XXXX",
+        max_chars=11,
+        placeholder="XXXX-XXXX-X" if get_secret("check_characters", False) else "XXXX-XXXX",
         key="code_input"
     ).upper()
     
+    # Flag typos as soon as the code is entered, before either button is clicked
+    typo = bool(code_input) and not has_valid_check_character(code_input)
+    if typo:
+        st.warning("⚠️ This code doesn't look right - please check it for typos")
+    
     col1, col2 = st.columns(2)
     
     with col1:
         if st.button("🔍 Check Code", use_container_width=True):
             if not code_input:
                 st.error("Please enter a code")
-            else:
-                with st.spinner("Checking..."):
-                    codes = load_codes(sheet)
-                    if code_input not in codes:
-                        st.error("❌ Invalid code")
-                    elif codes[code_input]["redeemed"]:
-                        st.warning("⚠️ This code has already been redeemed")
-                        # Show deal info for redeemed codes
-                        deal_text = codes[code_input].get("deal", "")
-                        if deal_text and deal_text.strip():
-                            st.markdown(f"""
-                                <h1 style="text-align: center; color: #1976d2; margin: 2rem 0;">
-                                    💼 {deal_text}
-                                </h1>
-                            """, unsafe_allow_html=True)
-                        else:
-                            st.info("No deal information associated with this code.")
-                    else:
-                        st.success("✅ Valid code! Ready to redeem.")
-                        # Show deal information
-                        deal_text = codes[code_input].get("deal", "")
-                        if deal_text and deal_text.strip():
-                            st.markdown(f"""
-                                <h1 style="text-align: center; color: #1976d2; margin: 2rem 0;">
-                                    💼 {deal_text}
-                                </h1>
-                            """, unsafe_allow_html=True)
-                        else:
-                            st.info("No deal information associated with this code.")
-    
-    with col2:
-        if st.button("✨ Redeem Code", use_container_width=True, type="primary"):
-            if not code_input:
-                st.error("Please enter a code")
-            else:
-                with st.spinner("Redeeming..."):
-                    codes = load_codes(sheet)
-                    if code_input not in codes:
-                        st.error("❌ Invalid code")
-                    else:
-                        # Debug: show what we're reading
-                        st.info(f"Debug - Code data: {codes[code_input]}")
-                        
-                        if codes[code_input]["redeemed"]:
+            elif allow_code_attempt():
+                if typo:
+                    # Rejected without looking the code up
+                    reject_code_attempt()
+                    st.error("❌ Invalid code")
+                else:
+                    with st.spinner("Checking..."):
+                        codes = get_codes(storage)
+                        if code_input not in codes:
+                            reject_code_attempt()
+                            st.error("❌ Invalid code")
+                        elif codes[code_input]["redeemed"]:
                             st.warning("⚠️ This code has already been redeemed")
-                            # Show deal info for already redeemed codes
+                            # Show deal info for redeemed codes
+                            deal_text = codes[code_input].get("deal", "")
+                            if deal_text and deal_text.strip():
+                                st.markdown(f"""
+                                    <h1 style="text-align: center; color: #1976d2; margin: 2rem 0;">
+                                        💼 {deal_text}
+                                    </h1>
+                                """, unsafe_allow_html=True)
+                            else:
+                                st.info("No deal information associated with this code.")
+                        else:
+                            st.success("✅ Valid code! Ready to redeem.")
+                            # Show deal information
                             deal_text = codes[code_input].get("deal", "")
                             if deal_text and deal_text.strip():
                                 st.markdown(f"""
@@ -359,11 +468,42 @@ with tab1:
                                         💼 {deal_text}
                                     </h1>
                                 """, unsafe_allow_html=True)
+                            else:
+                                st.info("No deal information associated with this code.")
+    
+    with col2:
+        if st.button("✨ Redeem Code", use_container_width=True, type="primary"):
+            if not code_input:
+                st.error("Please enter a code")
+            elif allow_code_attempt():
+                if typo:
+                    # Rejected without looking the code up
+                    reject_code_attempt()
+                    st.error("❌ Invalid code")
+                else:
+                    with st.spinner("Redeeming..."):
+                        codes = get_codes(storage)
+                        if code_input not in codes:
+                            reject_code_attempt()
+                            st.error("❌ Invalid code")
                         else:
                             # Store deal text before redemption
                             deal_text = codes[code_input].get("deal", "")
+                            outcome = redeem_code(storage, code_input)
                             
-                            if update_code_status(sheet, code_input, True):
+                            if outcome == UNKNOWN_CODE:
+                                reject_code_attempt()
+                                st.error("❌ Invalid code")
+                            elif outcome == ALREADY_REDEEMED:
+                                st.warning("⚠️ This code has already been redeemed")
+                                # Show deal info for already redeemed codes
+                                if deal_text and deal_text.strip():
+                                    st.markdown(f"""
+                                        <h1 style="text-align: center; color: #1976d2; margin: 2rem 0;">
+                                            💼 {deal_text}
+                                        </h1>
+                                    """, unsafe_allow_html=True)
+                            elif outcome == REDEEMED:
                                 st.success("🎉 Code successfully redeemed!")
                                 # Show deal information
                                 if deal_text and deal_text.strip():
@@ -419,7 +559,7 @@ with tab2:
             num_codes = st.number_input(
                 "Number of codes to generate:",
                 min_value=1,
-                max_value=1000,
+                max_value=MAX_CODES_PER_RUN,
                 value=10,
                 step=1
             )
@@ -430,23 +570,24 @@ with tab2:
             if st.button("➕ Generate", use_container_width=True, type="primary"):
                 with st.spinner(f"Generating {num_codes} codes..."):
                     try:
-                        codes = load_codes(sheet)
-                        new_codes = generate_unique_codes(num_codes, codes.keys())
+                        progress = st.progress(0.0)
                         
-                        # Add codes to sheet using batch operation
-                        if new_codes:
-                            result = save_codes_batch(sheet, new_codes, deal_input)
-                            
-                            if result:
-                                st.success(f"✅ Generated {len(new_codes)} new codes!")
-                                st.balloons()
-                                import time
-                                time.sleep(2)
-                                st.rerun()
-                            else:
-                                st.error("Failed to save codes to sheet")
+                        def show_progress(saved):
+                            progress.progress(saved / num_codes, text=f"Saved {saved:,} of {num_codes:,} codes")
+                        
+                        # Codes are written in chunks as they are generated
+                        saved = generate_and_save_codes(storage, num_codes, deal_input, show_progress)
+                        
+                        if saved == num_codes:
+                            st.success(f"✅ Generated {saved} new codes!")
+                            st.balloons()
+                            import time
+                            time.sleep(2)
+                            st.rerun()
+                        elif saved:
+                            st.warning(f"Only {saved} of {num_codes} codes were generated and saved.")
                         else:
-                            st.warning("Could not generate unique codes. Try a smaller number.")
+                            st.error("Failed to save codes to sheet")
                     except Exception as e:
                         st.error(f"Error during code generation: {str(e)}")
                         import traceback
@@ -458,23 +599,168 @@ with tab2:
         st.subheader("All Codes")
         
         if st.button("🔄 Refresh", key="refresh_codes"):
+            # Reload in full now rather than in the background
+            with st.spinner("Reloading codes..."):
+                get_codes(storage, force=True)
             st.rerun()
         
         with st.spinner("Loading codes..."):
-            codes = load_codes(sheet)
+            codes = get_codes(storage)
+        
+        index = get_code_index()
+        if index.is_degraded():
+            since = datetime.fromtimestamp(index.degraded_since).strftime("%Y-%m-%d %H:%M")
+            st.error(f"Codes couldn't be reloaded since {since}: {index.last_error}")
+        
+        scheduler = getattr(storage, 'scheduler', None)
+        if scheduler is not None:
+            with st.expander("Google Sheets API usage"):
+                api_stats = scheduler.stats()
+                col1, col2, col3 = st.columns(3)
+                col1.metric("Queued Requests", api_stats['queue_depth'])
+                col2.metric("Throttled", api_stats['throttled'])
+                col3.metric("Retries", api_stats['retries'])
+                st.caption(
+                    f"{api_stats['reads']} reads and {api_stats['writes']} writes sent, "
+                    f"{api_stats['coalesced_reads']} reads shared, {api_stats['merged_writes']} writes merged, "
+                    f"{api_stats['failures']} failed after retrying"
+                )
+        
+        journal = getattr(storage, 'journal', None)
+        if journal is not None:
+            with st.expander("Redemption journal"):
+                col1, col2, col3 = st.columns(3)
+                col1.metric("Waiting", f"{len(journal):,}")
+                col2.metric("Written", f"{storage.flushed:,}")
+                col3.metric("Dropped", f"{storage.dropped:,}")
+                st.caption(
+                    "Redemptions written to the sheet since the server started. "
+                    "Dropped ones were for codes no longer in the sheet."
+                )
+                if storage.last_flush_error:
+                    st.error(f"Last write failed: {storage.last_flush_error}")
+        
+        with st.expander("Code check protection"):
+            throttle_stats = get_client_throttle().stats()
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Attempts Allowed", f"{throttle_stats['allowed']:,}")
+            col2.metric("Invalid Codes", f"{throttle_stats['rejected']:,}")
+            col3.metric("Throttled", f"{throttle_stats['throttled']:,}")
+            st.caption(
+                f"Each session and IP address may try {get_client_throttle().attempts_per_minute} codes and "
+                f"{get_client_throttle().invalid_per_minute} invalid codes a minute. "
+                f"{throttle_stats['clients']:,} clients are being tracked."
+            )
+            if st.button("Reset Counters", key="reset_throttle"):
+                get_client_throttle().reset_counters()
+                st.rerun()
+        
+        with st.expander("Performance"):
+            if st.button("⏸️ Stop Collecting" if metrics.enabled else "▶️ Start Collecting", key="toggle_metrics"):
+                metrics.enabled = not metrics.enabled
+                st.rerun()
+            
+            perf = metrics.snapshot()
+            counters = perf['counters']
+            hits = counters.get('code_cache_hits', 0) + counters.get('code_cache_stale_hits', 0)
+            lookups = hits + counters.get('code_cache_misses', 0)
+            sheets_usage = perf['sheets'].values()
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Code Cache Hit Rate", f"{hits / lookups:.0%}" if lookups else "-")
+            col2.metric("Sheets Requests", sum(usage['requests'] for usage in sheets_usage))
+            col3.metric(
+                "Sheets Data",
+                f"{sum(usage['bytes_sent'] + usage['bytes_received'] for usage in sheets_usage) / 1024:,.0f} KB"
+            )
+            
+            if perf['operations']:
+                operations = sorted(perf['operations'].items())
+                st.dataframe(
+                    {
+                        'Operation': [name for name, _ in operations],
+                        'Calls': [summary['count'] for _, summary in operations],
+                        'p50 (ms)': [round(summary['p50'] * 1000, 1) for _, summary in operations],
+                        'p95 (ms)': [round(summary['p95'] * 1000, 1) for _, summary in operations],
+                        'p99 (ms)': [round(summary['p99'] * 1000, 1) for _, summary in operations]
+                    },
+                    use_container_width=True,
+                    hide_index=True
+                )
+            if perf['sheets']:
+                actions = sorted(perf['sheets'].items())
+                st.caption("Google Sheets traffic by the action that caused it")
+                st.dataframe(
+                    {
+                        'Action': [action for action, _ in actions],
+                        'Requests': [usage['requests'] for _, usage in actions],
+                        'Requests per Call': [
+                            round(usage['requests'] / perf['operations'][action]['count'], 2)
+                            if action in perf['operations'] else None
+                            for action, usage in actions
+                        ],
+                        'KB Sent': [round(usage['bytes_sent'] / 1024, 1) for _, usage in actions],
+                        'KB Received': [round(usage['bytes_received'] / 1024, 1) for _, usage in actions]
+                    },
+                    use_container_width=True,
+                    hide_index=True
+                )
+            
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.download_button(
+                    "Prometheus", data=metrics.to_prometheus, file_name="metrics.prom", mime="text/plain",
+                    on_click="ignore", use_container_width=True
+                )
+            with col2:
+                st.download_button(
+                    "JSON", data=metrics.to_json, file_name="metrics.json", mime="application/json",
+                    on_click="ignore", use_container_width=True
+                )
+            with col3:
+                if st.button("Reset", key="reset_metrics", use_container_width=True):
+                    metrics.reset()
+                    st.rerun()
         
         if not codes:
             st.info("No codes generated yet. Create some codes to get started!")
         else:
-            # Statistics
-            total_codes = len(codes)
-            redeemed_codes = sum(1 for c in codes.values() if c["redeemed"])
-            available_codes = total_codes - redeemed_codes
+            # Statistics - running totals kept by the code store, so nothing is counted here
+            stats = codes.stats()
             
             col1, col2, col3 = st.columns(3)
-            col1.metric("Total Codes", total_codes)
-            col2.metric("Available", available_codes)
-            col3.metric("Redeemed", redeemed_codes)
+            col1.metric("Total Codes", stats.total)
+            col2.metric("Available", stats.available)
+            col3.metric("Redeemed", stats.redeemed)
+            
+            with st.expander("📊 Deal Statistics"):
+                deal_rows = stats.by_deal()
+                st.dataframe(
+                    {
+                        'Deal': [deal or "(no deal)" for deal, _, _, _ in deal_rows],
+                        'Total': [total for _, total, _, _ in deal_rows],
+                        'Available': [available for _, _, available, _ in deal_rows],
+                        'Redeemed': [redeemed for _, _, _, redeemed in deal_rows],
+                        'Redeemed %': [round(100 * redeemed / total, 1) for _, total, _, redeemed in deal_rows]
+                    },
+                    use_container_width=True,
+                    hide_index=True
+                )
+                
+                week_ago = (datetime.now() - timedelta(days=REDEMPTION_CHART_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+                hours = stats.redemptions_per_hour(since=week_ago)
+                if hours:
+                    st.caption(f"Redemptions per hour over the last {REDEMPTION_CHART_DAYS} days")
+                    st.bar_chart(
+                        {'Hour': [hour for hour, _ in hours], 'Redemptions': [count for _, count in hours]},
+                        x='Hour',
+                        y='Redemptions'
+                    )
+                else:
+                    st.caption(f"No redemptions in the last {REDEMPTION_CHART_DAYS} days")
+            
+            journal = getattr(storage, 'journal', None)
+            if journal is not None and len(journal):
+                st.caption(f"{len(journal)} redemptions waiting to be written to the sheet")
             
             st.markdown("---")
             
@@ -489,8 +775,8 @@ with tab2:
                 ).upper()
             
             with col2:
-                # Get unique deals for dropdown
-                unique_deals = sorted(set(c["deal"] for c in codes.values() if c["deal"]))
+                # Get unique deals for dropdown from the running per-deal counts
+                unique_deals = stats.deal_names()
                 deal_options = ["All Deals"] + unique_deals
                 selected_deal = st.selectbox(
                     "Filter by Deal:",
@@ -499,35 +785,34 @@ with tab2:
                 )
             
             # Filter options
-            filter_option = st.radio(
-                "Status Filter:",
-                ["All", "Available Only", "Redeemed Only"],
-                horizontal=True
-            )
+            col1, col2 = st.columns([2, 1])
             
-            # Apply all filters
-            filtered_codes = {}
-            for k, v in codes.items():
-                # Status filter
-                if filter_option == "Available Only" and v["redeemed"]:
-                    continue
-                if filter_option == "Redeemed Only" and not v["redeemed"]:
-                    continue
-                
-                # Deal filter
-                if selected_deal != "All Deals" and v["deal"] != selected_deal:
-                    continue
-                
-                # Search filter
-                if search_query and search_query not in k:
-                    continue
-                
-                filtered_codes[k] = v
+            with col1:
+                filter_option = st.radio(
+                    "Status Filter:",
+                    ["All", "Available Only", "Redeemed Only"],
+                    horizontal=True
+                )
+            
+            with col2:
+                codes_per_page = st.selectbox(
+                    "Rows per page:",
+                    options=PAGE_SIZE_OPTIONS,
+                    index=PAGE_SIZE_OPTIONS.index(500),
+                    key="page_size"
+                )
+            
+            # Apply all filters through the secondary indexes
+            filters = {
+                "redeemed": {"All": None, "Available Only": False, "Redeemed Only": True}[filter_option],
+                "deal": None if selected_deal == "All Deals" else selected_deal,
+                "search": search_query
+            }
+            filtered_codes = codes.query_index().query(**filters)
             
             # Pagination setup
-            CODES_PER_PAGE = 50
-            total_filtered = len(filtered_codes)
-            total_pages = max(1, (total_filtered + CODES_PER_PAGE - 1) // CODES_PER_PAGE)
+            total_filtered = filtered_codes.count
+            total_pages = max(1, (total_filtered + codes_per_page - 1) // codes_per_page)
             
             # Initialize page number in session state
             if 'current_page' not in st.session_state:
@@ -538,11 +823,33 @@ with tab2:
                 st.session_state.current_page = 1
             
             # Display filtered count
-            st.info(f"Showing {len(filtered_codes)} of {total_codes} codes")
+            st.info(f"Showing {total_filtered} of {stats.total} codes")
+            
+            # Export the filtered codes - the file is only built once the button is clicked
+            col1, col2 = st.columns([1, 2])
+            
+            with col1:
+                export_format = st.selectbox(
+                    "Export format:",
+                    options=list(EXPORT_FORMATS),
+                    format_func=str.upper,
+                    key="export_format"
+                )
+            
+            with col2:
+                export_mime, export_extension = EXPORT_FORMATS[export_format]
+                st.download_button(
+                    f"📥 Download {total_filtered} Codes",
+                    data=lambda: build_export(codes, export_format, **filters),
+                    file_name=f"codes.{export_extension}",
+                    mime=export_mime,
+                    on_click="ignore",
+                    disabled=not total_filtered
+                )
             
             st.markdown("---")
             
-            if filtered_codes:
+            if total_filtered:
                 # Pagination controls
                 if total_pages > 1:
                     col1, col2, col3, col4, col5 = st.columns([1, 1, 2, 1, 1])
@@ -573,97 +880,176 @@ with tab2:
                     st.markdown("---")
                 
                 # Calculate pagination slice
-                start_idx = (st.session_state.current_page - 1) * CODES_PER_PAGE
-                end_idx = start_idx + CODES_PER_PAGE
+                start_idx = (st.session_state.current_page - 1) * codes_per_page
                 
-                # Get codes for current page
-                sorted_codes = sorted(filtered_codes.items())
-                page_codes = sorted_codes[start_idx:end_idx]
+                # Get codes for current page, already in code order
+                page_codes = filtered_codes.page(start_idx, codes_per_page)
                 
                 # Show how many codes are being displayed on this page
                 codes_on_page = len(page_codes)
                 st.caption(f"Displaying codes {start_idx + 1} to {start_idx + codes_on_page} of {total_filtered} filtered codes")
                 
-                # Display codes with reinvoke option
-                for code, data in page_codes:
-                    status = "Redeemed" if data["redeemed"] else "Available"
-                    css_class = "code-redeemed" if data["redeemed"] else "code-available"
-                    
-                    col1, col2 = st.columns([3, 1])
-                    
-                    with col1:
-                        redeemed_info = ""
-                        if data["redeemed"] and data.get("redeemed_at"):
-                            redeemed_info = f"<div style='font-size: 0.8em; margin-top: 0.3rem; color: #666;'>Redeemed: {data['redeemed_at']}</div>"
-                        
-                        deal_info = ""
-                        if data.get("deal") and data["deal"].strip():
-                            deal_info = f"<div style='font-size: 0.85em; margin-top: 0.3rem; color: #1976d2;'>💼 {data['deal']}</div>"
-                        
-                        st.markdown(f"""
-                            <div class="code-box {css_class}">
-                                <div style="font-size: 1.2em; font-weight: bold; font-family: monospace;">
-                                    {data['code']}
-                                </div>
-                                <div style="font-size: 0.8em; margin-top: 0.3rem;">
-                                    Status: {status}
-                                </div>
-                                {deal_info}
-                                {redeemed_info}
-                            </div>
-                        """, unsafe_allow_html=True)
-                    
-                    with col2:
-                        # Show reinvoke button only for redeemed codes
-                        if data["redeemed"]:
-                            if st.button("🔄 Reinvoke", key=f"reinvoke_{code}", use_container_width=True):
-                                with st.spinner(f"Reinvoking {code}..."):
-                                    if update_code_status(sheet, code, False):
-                                        st.success(f"✅ Code {code} has been reinstated!")
-                                        st.rerun()
-                                    else:
-                                        st.error(f"Error reinvoking {code}")
-                        else:
-                            st.write("")  # Spacing for alignment
+                # Display the page as one scrollable grid - only the Select
+                # column is editable, and ticking rows doesn't rebuild the page
+                grid = {
+                    "Select": [False] * codes_on_page,
+                    "Code": [code for code, _ in page_codes],
+                    "Deal": [data["deal"] for _, data in page_codes],
+                    "Status": ["Redeemed" if data["redeemed"] else "Available" for _, data in page_codes],
+                    "Redeemed At": [data["redeemed_at"] for _, data in page_codes],
+                }
                 
-                # Bottom pagination controls (for convenience on long pages)
-                if total_pages > 1:
-                    st.markdown("---")
-                    col1, col2, col3, col4, col5 = st.columns([1, 1, 2, 1, 1])
-                    
-                    with col1:
-                        if st.button("⏮️ First ", disabled=(st.session_state.current_page == 1), use_container_width=True, key="first_bottom"):
-                            st.session_state.current_page = 1
-                            st.rerun()
-                    
-                    with col2:
-                        if st.button("◀️ Previous ", disabled=(st.session_state.current_page == 1), use_container_width=True, key="prev_bottom"):
-                            st.session_state.current_page -= 1
-                            st.rerun()
-                    
-                    with col3:
-                        st.markdown(f"<div class='pagination-info'><strong>Page {st.session_state.current_page} of {total_pages}</strong></div>", unsafe_allow_html=True)
-                    
-                    with col4:
-                        if st.button("Next ▶️ ", disabled=(st.session_state.current_page == total_pages), use_container_width=True, key="next_bottom"):
-                            st.session_state.current_page += 1
-                            st.rerun()
-                    
-                    with col5:
-                        if st.button("Last ⏭️ ", disabled=(st.session_state.current_page == total_pages), use_container_width=True, key="last_bottom"):
-                            st.session_state.current_page = total_pages
-                            st.rerun()
+                # Key on the filters and page, so selections reset when other rows are shown
+                # but survive redemptions elsewhere changing the index
+                grid_key = f"codes_grid_{filter_option}_{selected_deal}_{search_query}_{st.session_state.current_page}_{codes_per_page}"
+                edited = st.data_editor(
+                    grid,
+                    key=grid_key,
+                    hide_index=True,
+                    use_container_width=True,
+                    height=min(600, 38 + 35 * codes_on_page),
+                    disabled=["Code", "Deal", "Status", "Redeemed At"],
+                    column_config={
+                        "Select": st.column_config.CheckboxColumn("Select", default=False),
+                    }
+                )
+                selected_codes = [code for code, picked in zip(grid["Code"], edited["Select"]) if picked]
+                
+                # Bulk actions - one batched write for every selected code
+                col1, col2, col3 = st.columns([1, 1, 2])
+                
+                with col1:
+                    reinvoke_clicked = st.button(
+                        "🔄 Reinvoke Selected",
+                        disabled=not selected_codes,
+                        use_container_width=True
+                    )
+                
+                with col2:
+                    redeem_clicked = st.button(
+                        "✨ Redeem Selected",
+                        disabled=not selected_codes,
+                        use_container_width=True
+                    )
+                
+                with col3:
+                    st.caption(f"{len(selected_codes)} selected")
+                
+                if reinvoke_clicked or redeem_clicked:
+                    action = "Reinvoking" if reinvoke_clicked else "Redeeming"
+                    with st.spinner(f"{action} {len(selected_codes)} codes..."):
+                        results = bulk_update_code_status(storage, selected_codes, redeemed=redeem_clicked)
+                    if results is not None:
+                        applied = sum(1 for outcome in results.values() if outcome == APPLIED)
+                        st.success(f"✅ Updated {applied} of {len(selected_codes)} selected codes")
+                        # Start the page over with nothing selected
+                        st.session_state.pop(grid_key, None)
+                        st.rerun()
             else:
                 st.info("No codes match the selected filter.")
             
+            # Status changes for a list of codes, e.g. end-of-day reconciliation
+            st.markdown("---")
+            st.subheader("Bulk Status Update")
+            
+            uploaded_file = st.file_uploader("Upload a CSV of codes (first column):", type=["csv", "txt"], key="bulk_file")
+            pasted_codes = st.text_area("Or paste codes, one per line:", key="bulk_codes")
+            bulk_action = st.radio("Action:", ["Redeem", "Reinvoke"], horizontal=True, key="bulk_action")
+            
+            if st.button("Apply to Codes", key="bulk_apply"):
+                text = uploaded_file.getvalue().decode("utf-8-sig") if uploaded_file is not None else pasted_codes
+                bulk_codes = parse_code_list(text)
+                if not bulk_codes:
+                    st.error("Please upload or paste some codes")
+                else:
+                    with st.spinner(f"Updating {len(set(bulk_codes))} codes..."):
+                        results = bulk_update_code_status(storage, bulk_codes, redeemed=bulk_action == "Redeem")
+                    if results is not None:
+                        st.session_state.bulk_results = (bulk_action, results)
+                        st.rerun()
+            
+            if st.session_state.get('bulk_results'):
+                bulk_action, results = st.session_state.bulk_results
+                labels = {
+                    APPLIED: "Redeemed" if bulk_action == "Redeem" else "Reinvoked",
+                    UNCHANGED: "Already redeemed" if bulk_action == "Redeem" else "Already available",
+                    UNKNOWN_CODE: "Unknown code"
+                }
+                counts = {outcome: 0 for outcome in labels}
+                for outcome in results.values():
+                    counts[outcome] += 1
+                st.success(
+                    f"✅ {bulk_action}: {counts[APPLIED]} applied, {counts[UNCHANGED]} already in that state, "
+                    f"{counts[UNKNOWN_CODE]} unknown"
+                )
+                st.dataframe(
+                    {
+                        'Code': list(results),
+                        'Result': [labels[outcome] for outcome in results.values()]
+                    },
+                    use_container_width=True,
+                    hide_index=True
+                )
+                if st.button("Clear Results", key="bulk_clear"):
+                    del st.session_state.bulk_results
+                    st.rerun()
+            
+            # Journaled redemptions that clashed with ones already in the sheet
+            journal = getattr(storage, 'journal', None)
+            conflicts = journal.conflicts() if journal is not None else []
+            if conflicts:
+                st.markdown("---")
+                st.subheader("Redemption Conflicts")
+                st.warning(
+                    f"{len(conflicts)} codes redeemed here had already been redeemed elsewhere by the time they were written. "
+                    "The sheet keeps the other redemption."
+                )
+                st.dataframe(
+                    {
+                        'Code': [c['code'] for c in conflicts],
+                        'Redeemed Here At': [c['redeemed_at'] for c in conflicts],
+                        'Sheet Redeemed At': [c['stored_redeemed_at'] for c in conflicts],
+                        'Detected At': [c['detected_at'] for c in conflicts]
+                    },
+                    use_container_width=True,
+                    hide_index=True
+                )
+                if st.button("Dismiss Conflicts"):
+                    journal.clear_conflicts()
+                    st.rerun()
+            
             # Delete all codes (dangerous action)
             st.markdown("---")
             st.subheader("⚠️ Danger Zone")
             
+            # Retire one deal's codes, leaving every other deal live
+            if unique_deals:
+                col1, col2 = st.columns([2, 1])
+                
+                with col1:
+                    retired_deal = st.selectbox("Deal to retire:", options=unique_deals, key="retire_deal")
+                
+                with col2:
+                    archive_retired = st.checkbox(
+                        f"Copy to the {ARCHIVE_SHEET} sheet first", value=True, key="archive_retired"
+                    )
+                
+                if st.button("🗑️ Delete Deal Codes", type="secondary"):
+                    if st.session_state.get('confirm_delete_deal') == retired_deal:
+                        with st.spinner(f"Deleting codes for {retired_deal}..."):
+                            deleted = delete_deal_codes(storage, retired_deal, archive_retired)
+                        st.session_state.confirm_delete_deal = None
+                        if deleted is not None:
+                            st.success(f"Deleted {deleted} codes for {retired_deal}")
+                            st.rerun()
+                    else:
+                        st.session_state.confirm_delete_deal = retired_deal
+                        st.warning(f"⚠️ Click again to confirm deletion of every code for {retired_deal}!")
+            
             if st.button("🗑️ Delete All Codes", type="secondary"):
                 if st.session_state.get('confirm_delete'):
                     with st.spinner("Deleting all codes..."):
-                        if delete_all_codes(sheet):
+                        if delete_all_codes(storage):
                             st.session_state.confirm_delete = False
                             st.success("All codes deleted!")
                             st.rerun()
@@ -684,6 +1070,9 @@ st.markdown("""
         <p>💡 Codes are stored in Google Sheets for persistence</p>
         <p>🔐 Admin password configured via Streamlit secrets</p>
         <p>💼 Associate deals with code batches for better tracking</p>
-        <p>📄 Viewing 50 codes per page for optimal performance</p>
+        <p>📄 Codes are listed in a grid with a configurable page size</p>
     </div>
 """, unsafe_allow_html=True)
+
+if metrics.enabled:
+    metrics.observe('page_render', time.perf_counter() - page_started)
@@ -0,0 +1,102 @@
+"""FakeWorksheet that behaves like the Sheets API over a network, for benchmarks"""
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import FakeWorksheet
+
+
+class FakeResponse:
+    """Just enough of a requests.Response for is_retryable() to read the status"""
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeAPIError(Exception):
+    """Stand-in for gspread.exceptions.APIError"""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.response = FakeResponse(status_code)
+
+
+class LatencyWorksheet(FakeWorksheet):
+    """FakeWorksheet whose every API call waits like a round trip and sometimes hits the quota
+
+    Each call sleeps for latency seconds plus up to jitter more, and fails
+    with a 429 a share error_rate of the time, as Sheets does once the
+    per-minute quota is used up. Calls and errors are counted.
+    """
+
+    def __init__(self, rows=None, row_count=1000, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        super().__init__(rows, row_count)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._count_lock = threading.Lock()
+
+    def _round_trip(self):
+        with self._count_lock:
+            self.calls += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            refused = self._random.random() < self.error_rate
+            if refused:
+                self.errors += 1
+        if delay:
+            time.sleep(delay)
+        if refused:
+            raise FakeAPIError(429, "Quota exceeded for quota metric 'Read requests'")
+
+    def row_values(self, row):
+        self._round_trip()
+        return super().row_values(row)
+
+    def col_values(self, col):
+        self._round_trip()
+        return super().col_values(col)
+
+    def get_all_values(self):
+        self._round_trip()
+        return super().get_all_values()
+
+    def get(self, range_name):
+        self._round_trip()
+        return super().get(range_name)
+
+    def batch_get(self, ranges):
+        self._round_trip()
+        return [FakeWorksheet.get(self, range_name) for range_name in ranges]
+
+    def acell(self, label):
+        self._round_trip()
+        return super().acell(label)
+
+    def update(self, values=None, range_name=None, value_input_option='RAW'):
+        self._round_trip()
+        return super().update(values=values, range_name=range_name, value_input_option=value_input_option)
+
+    def batch_update(self, data, value_input_option='RAW'):
+        self._round_trip()
+        for item in data:
+            FakeWorksheet.update(self, values=item['values'], range_name=item['range'],
+                                 value_input_option=value_input_option)
+
+    def append_rows(self, values, value_input_option='RAW', insert_data_option=None, table_range=None):
+        self._round_trip()
+        return super().append_rows(values, value_input_option, insert_data_option, table_range)
+
+    def add_rows(self, rows):
+        self._round_trip()
+        return super().add_rows(rows)
+
+    def delete_rows(self, start_index, end_index=None):
+        self._round_trip()
+        return super().delete_rows(start_index, end_index)
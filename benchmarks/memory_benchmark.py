@@ -0,0 +1,91 @@
+"""Compare the memory used by CompactCodeStore with the old dict of record dicts
+
+Usage: python benchmarks/memory_benchmark.py [--codes 500000] [--deals 20] [--redeemed 0.3]
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from code_store import CompactCodeStore
+from codegen import generate_unique_codes
+
+
+def make_rows(num_codes, num_deals, redeemed_share):
+    """Build sheet-like rows of code, deal, redeemed and redeemed at"""
+    codes = generate_unique_codes(num_codes, set())
+    rows = []
+    for code in codes:
+        redeemed = random.random() < redeemed_share
+        rows.append([
+            code,
+            f"Promotion {random.randrange(num_deals)} - 20% off".strip(),
+            'TRUE' if redeemed else 'FALSE',
+            f"2026-{random.randint(1, 12):02d}-{random.randint(1, 28):02d} 12:{random.randint(0, 59):02d}:00" if redeemed else ''
+        ])
+    return rows
+
+
+def build_dict_of_dicts(rows):
+    """The representation load_codes used to return"""
+    codes = {}
+    for code, deal, redeemed, redeemed_at in rows:
+        codes[code] = {
+            'code': code,
+            'deal': deal,
+            'redeemed': redeemed == 'TRUE',
+            'redeemed_at': redeemed_at
+        }
+    return codes
+
+
+def build_compact(rows):
+    codes = CompactCodeStore()
+    for code, deal, redeemed, redeemed_at in rows:
+        codes.add(code, deal, redeemed == 'TRUE', redeemed_at)
+    return codes
+
+
+def copy_rows(rows):
+    """Copy every string, as each get_all_values() call returns fresh ones"""
+    return [[''.join(value) for value in row] for row in rows]
+
+
+def measure(builder, rows):
+    """Return what builder() returned and the bytes it still holds once the rows are freed"""
+    gc.collect()
+    tracemalloc.start()
+    fresh_rows = copy_rows(rows)
+    result = builder(fresh_rows)
+    del fresh_rows
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--codes', type=int, default=500_000)
+    parser.add_argument('--deals', type=int, default=20)
+    parser.add_argument('--redeemed', type=float, default=0.3)
+    args = parser.parse_args()
+
+    rows = make_rows(args.codes, args.deals, args.redeemed)
+
+    old, old_size = measure(build_dict_of_dicts, rows)
+    new, new_size = measure(build_compact, rows)
+    assert all(old[code] == new[code] for code in random.sample(list(old), min(1000, len(old))))
+
+    print(f"codes:              {args.codes:,}")
+    print(f"dict of dicts:      {old_size / 1e6:8.1f} MB ({old_size / args.codes:.0f} B/code)")
+    print(f"CompactCodeStore:   {new_size / 1e6:8.1f} MB ({new_size / args.codes:.0f} B/code)")
+    print(f"reduction:          {old_size / new_size:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
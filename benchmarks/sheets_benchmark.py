@@ -0,0 +1,319 @@
+"""Benchmark the code table hot paths against a fake Sheets backend with injected latency
+
+Usage: python benchmarks/sheets_benchmark.py [--rows 1000 100000] [--latency 0.05] [--error-rate 0.01]
+           [--cashiers 8] [--checkouts 400] [--journal] [--output results.json]
+
+Runs load_codes, save_codes_batch, update_code_status, generate_unique_codes,
+the admin filter/paginate queries and concurrent check-and-redeem cashiers
+for each row count, prints throughput and tail latency, and saves the
+results as JSON so runs can be compared over time.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from code_index import CodeIndex, REDEEMED
+from codegen import generate_unique_codes
+from fake_sheets import LatencyWorksheet
+from journal import RedemptionJournal, JournaledStorage
+from sheets_scheduler import SheetsScheduler
+from storage import SheetsStorage, HEADERS
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# Codes written per save_codes_batch call, as the app does
+CODES_PER_WRITE = 10_000
+
+# Status updates timed per run
+STATUS_UPDATES = 50
+
+# Deals the generated codes are spread across
+DEALS = 20
+
+# Admin page size used for the paging queries
+PAGE_SIZE = 500
+
+
+def percentile(sorted_samples, q):
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[min(len(sorted_samples) - 1, int(q * len(sorted_samples)))]
+
+
+def summarize(samples, elapsed=None):
+    """Get count, throughput and latency percentiles in milliseconds for a list of seconds"""
+    samples = sorted(samples)
+    summary = {
+        'count': len(samples),
+        'p50_ms': percentile(samples, 0.5) * 1000,
+        'p95_ms': percentile(samples, 0.95) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'max_ms': (samples[-1] if samples else 0.0) * 1000
+    }
+    total = elapsed if elapsed is not None else sum(samples)
+    summary['ops_per_second'] = len(samples) / total if total else 0.0
+    return summary
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def make_rows(num_rows, redeemed_share=0.3):
+    """Build sheet rows of unique codes spread across DEALS deals, some redeemed"""
+    rows = [list(HEADERS)]
+    for code in generate_unique_codes(num_rows, set()):
+        redeemed = random.random() < redeemed_share
+        rows.append([
+            code,
+            f"Promotion {random.randrange(DEALS)}",
+            'TRUE' if redeemed else 'FALSE',
+            f"2026-{random.randint(1, 12):02d}-{random.randint(1, 28):02d} 12:00:00" if redeemed else ''
+        ])
+    return rows
+
+
+def open_storage(rows, args):
+    worksheet = LatencyWorksheet(
+        rows, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed
+    )
+    scheduler = SheetsScheduler(
+        reads_per_minute=args.requests_per_minute,
+        writes_per_minute=args.requests_per_minute,
+        # Scale retry backoff down so quota errors don't dominate the run
+        sleep=lambda seconds: time.sleep(seconds * args.backoff_scale)
+    )
+    storage = SheetsStorage(worksheet, scheduler=scheduler)
+    return worksheet, scheduler, storage
+
+
+def bench_load(rows, args):
+    worksheet, _, storage = open_storage(rows, args)
+    samples = []
+    for _ in range(args.repeat):
+        _, seconds = timed(storage.load_codes)
+        samples.append(seconds)
+    return {'load_codes': summarize(samples), 'sheet_calls': worksheet.calls}
+
+
+def bench_save(args, num_codes):
+    worksheet, _, storage = open_storage([list(HEADERS)], args)
+    codes_list = generate_unique_codes(num_codes, set())
+    samples = []
+    started = time.perf_counter()
+    for offset in range(0, num_codes, CODES_PER_WRITE):
+        _, seconds = timed(storage.save_codes_batch, codes_list[offset:offset + CODES_PER_WRITE], 'Bench')
+        samples.append(seconds)
+    elapsed = time.perf_counter() - started
+    return {
+        'save_codes_batch': summarize(samples),
+        'codes_per_second': num_codes / elapsed if elapsed else 0.0,
+        'sheet_calls': worksheet.calls
+    }
+
+
+def bench_update_status(rows, args):
+    worksheet, _, storage = open_storage(rows, args)
+    storage.load_codes()
+    codes_list = random.sample([row[0] for row in rows[1:]], min(STATUS_UPDATES, len(rows) - 1))
+    results = {}
+    # Row numbers are checked against the sheet unless the index is known fresh
+    for verify_row in (False, True):
+        samples = []
+        for code in codes_list:
+            _, seconds = timed(storage.update_code_status, code, True, '2026-01-01 12:00:00', verify_row)
+            samples.append(seconds)
+        results['verified' if verify_row else 'fresh_index'] = summarize(samples)
+    results['sheet_calls'] = worksheet.calls
+    return results
+
+
+def bench_generate(num_codes):
+    existing = set()
+    _, seconds = timed(generate_unique_codes, num_codes, existing)
+    return {'seconds': seconds, 'codes_per_second': num_codes / seconds if seconds else 0.0}
+
+
+def bench_admin(rows, args):
+    _, _, storage = open_storage(rows, args)
+    codes = storage.load_codes()
+    results = {}
+    query_index, results['build_query_index_ms'] = timed(codes.query_index)
+    results['build_query_index_ms'] *= 1000
+
+    deal = "Promotion 0"
+    queries = {
+        'all': {},
+        'available': {'redeemed': False},
+        'redeemed_in_deal': {'redeemed': True, 'deal': deal},
+        'search_2_chars': {'search': 'AB'},
+        'search_4_chars': {'search': 'AB1C'}
+    }
+    for name, filters in queries.items():
+        samples = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = query_index.query(**filters)
+            last_page = max(0, (result.count - 1) // PAGE_SIZE) * PAGE_SIZE
+            result.page(0, PAGE_SIZE)
+            result.page(last_page, PAGE_SIZE)
+            samples.append(time.perf_counter() - start)
+        results[name] = summarize(samples)
+    return results
+
+
+def bench_cashiers(rows, args):
+    """Concurrent cashiers each checking a code, then redeeming it"""
+    worksheet, scheduler, storage = open_storage(rows, args)
+    index = CodeIndex()
+    if args.journal:
+        journal_path = os.path.join(tempfile.mkdtemp(), 'redemptions.db')
+        storage = JournaledStorage(storage, RedemptionJournal(journal_path), is_fresh=index.is_fresh,
+                                   is_degraded=index.is_degraded)
+    index.get_codes(storage.load_codes, syncer=storage.sync_codes)
+
+    available = [row[0] for row in rows[1:] if row[2] == 'FALSE']
+    random.shuffle(available)
+    pending = available[:args.checkouts]
+    pending_lock = threading.Lock()
+    check_samples = []
+    redeem_samples = []
+    outcomes = {}
+    errors = []
+
+    def cashier():
+        while True:
+            with pending_lock:
+                if not pending:
+                    return
+                code = pending.pop()
+            try:
+                start = time.perf_counter()
+                record = index.get_codes(storage.load_codes, syncer=storage.sync_codes).get(code)
+                checked = time.perf_counter()
+                outcome = index.redeem(storage, code, '2026-01-01 12:00:00') if record else None
+                redeemed = time.perf_counter()
+            except Exception as e:
+                errors.append(str(e))
+                continue
+            with pending_lock:
+                check_samples.append(checked - start)
+                redeem_samples.append(redeemed - checked)
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    threads = [threading.Thread(target=cashier) for _ in range(args.cashiers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    results = {
+        'cashiers': args.cashiers,
+        'journal': args.journal,
+        'checkouts_per_second': len(redeem_samples) / elapsed if elapsed else 0.0,
+        'check': summarize(check_samples),
+        'redeem': summarize(redeem_samples),
+        'redeemed': outcomes.get(REDEEMED, 0),
+        'errors': len(errors),
+        'sheet_calls': worksheet.calls,
+        'sheet_errors': worksheet.errors,
+        'scheduler': scheduler.stats()
+    }
+    if args.journal:
+        storage.close()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def print_summary(name, summary):
+    print(f"  {name:<28} {summary['count']:>6} ops  {summary['ops_per_second']:>10.1f}/s  "
+          f"p50 {summary['p50_ms']:>8.2f} ms  p95 {summary['p95_ms']:>8.2f} ms  p99 {summary['p99_ms']:>8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds per Sheets call")
+    parser.add_argument('--jitter', type=float, default=0.02, help="extra random seconds per call, up to")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of calls refused with a 429")
+    parser.add_argument('--requests-per-minute', type=int, default=6000, help="scheduler quota per bucket")
+    parser.add_argument('--backoff-scale', type=float, default=0.01, help="multiplier on retry backoff sleeps")
+    parser.add_argument('--cashiers', type=int, default=8)
+    parser.add_argument('--checkouts', type=int, default=400)
+    parser.add_argument('--journal', action='store_true', help="redeem through the redemption journal")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help=f"JSON results file (default: a new file in {RESULTS_DIR})")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    runs = []
+    for num_rows in args.rows:
+        print(f"{num_rows:,} rows")
+        rows = make_rows(num_rows)
+        run = {
+            'rows': num_rows,
+            'load': bench_load(rows, args),
+            'save': bench_save(args, min(num_rows, 10 * CODES_PER_WRITE)),
+            'update_status': bench_update_status(rows, args),
+            'generate_unique_codes': bench_generate(num_rows),
+            'admin': bench_admin(rows, args),
+            'cashiers': bench_cashiers(rows, args)
+        }
+        runs.append(run)
+
+        print_summary('load_codes', run['load']['load_codes'])
+        print_summary('save_codes_batch', run['save']['save_codes_batch'])
+        print_summary('update_code_status (fresh)', run['update_status']['fresh_index'])
+        print_summary('update_code_status (verify)', run['update_status']['verified'])
+        print(f"  {'generate_unique_codes':<28} {run['generate_unique_codes']['codes_per_second']:>17,.0f} codes/s")
+        for name, summary in run['admin'].items():
+            if isinstance(summary, dict):
+                print_summary(f"admin {name}", summary)
+        cashiers = run['cashiers']
+        print(f"  {args.cashiers} cashiers: {cashiers['checkouts_per_second']:.1f} checkouts/s, "
+              f"{cashiers['errors']} errors, {cashiers['sheet_calls']} sheet calls")
+        print_summary('check', cashiers['check'])
+        print_summary('redeem', cashiers['redeem'])
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"sheets-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, 'w') as f:
+        json.dump({
+            'benchmark': 'sheets',
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+            'runs': runs
+        }, f, indent=2)
+    print(f"Results saved to {output}")
+
+
+if __name__ == '__main__':
+    main()
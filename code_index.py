@@ -0,0 +1,306 @@
+import collections
+import threading
+import time
+
+from code_store import CompactCodeStore
+from shared_cache import RELOAD
+
+# Seconds a loaded code table is trusted before it is read again from the sheet
+DEFAULT_TTL = 300
+
+# Seconds between attempts to reach storage again after a refresh failed
+RETRY_INTERVAL = 30
+
+# Locks writes to codes are serialized by - codes sharing one just wait on each other
+CODE_LOCK_STRIPES = 1024
+
+# Outcomes of a redeem-if-unredeemed attempt
+REDEEMED = 'redeemed'
+ALREADY_REDEEMED = 'already_redeemed'
+UNKNOWN_CODE = 'unknown'
+
+# Per-code outcomes of a bulk status change
+APPLIED = 'applied'
+UNCHANGED = 'unchanged'
+
+
+class CodeIndex:
+    """Process-wide cache of the code table, shared by every Streamlit session"""
+
+    def __init__(self, ttl=DEFAULT_TTL, retry_interval=RETRY_INTERVAL, change_log=None):
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        # Optional SharedChangeLog our changes are published to and other
+        # processes' changes are read from
+        self.change_log = change_log
+        self.codes = CompactCodeStore()
+        self.version = 0
+        self.loaded_at = None
+        # Whether codes holds a complete table, possibly a stale one
+        self.loaded = False
+        # Wall-clock time of the last successful load or sync
+        self.refreshed_at = None
+        # Set while storage can't be reached and stale codes are being served
+        self.degraded_since = None
+        self.last_error = None
+        self.retry_at = None
+        # Set by invalidate() so the next refresh reloads rather than syncs
+        self.reload_requested = False
+        self._refreshing = False
+        self._refreshing_lock = threading.Lock()
+        self._lock = threading.RLock()
+        # Updates made while a refresh held the lock, applied once it is free
+        self._deferred = collections.deque()
+        self._code_locks = [threading.Lock() for _ in range(CODE_LOCK_STRIPES)]
+
+    def is_fresh(self):
+        """Check whether the cached table is loaded and inside its TTL"""
+        if self.loaded_at is None:
+            return False
+        return time.monotonic() - self.loaded_at < self.ttl
+
+    def is_degraded(self):
+        """Check whether stale codes are being served because storage is unreachable"""
+        return self.degraded_since is not None
+
+    def _backing_off(self):
+        retry_at = self.retry_at
+        return retry_at is not None and time.monotonic() < retry_at
+
+    def get_codes(self, loader, force=False, syncer=None):
+        """Return the cached codes, refreshing them when stale
+
+        syncer(codes) is tried first to apply just what changed; if it returns
+        False, or on force, loader() rebuilds the whole table. Once a table is
+        loaded, stale ones are refreshed in a background thread while the
+        current table keeps being served. If a refresh fails, the last good
+        table is served in degraded mode and storage is tried again every
+        retry_interval seconds.
+        """
+        self.apply_shared_changes()
+
+        # Fast path - no lock needed to hand out the current store
+        if not force and (self.is_fresh() or self._backing_off()):
+            return self.codes
+
+        # With a table to serve, don't make this session wait for storage
+        if not force and self.loaded:
+            self._start_background_refresh(loader, syncer)
+            return self.codes
+
+        self._refresh_locked(loader, force, syncer)
+        return self.codes
+
+    def _start_background_refresh(self, loader, syncer):
+        with self._refreshing_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(
+            target=self._background_refresh, args=(loader, syncer), name='code-index-refresh', daemon=True
+        ).start()
+
+    def _background_refresh(self, loader, syncer):
+        try:
+            self._refresh_locked(loader, False, syncer)
+        finally:
+            self._refreshing = False
+
+    def _refresh_locked(self, loader, force, syncer):
+        with self._lock:
+            # Another session may have reloaded while we waited for the lock
+            if force or not (self.is_fresh() or self._backing_off()):
+                try:
+                    self._refresh(loader, force, syncer)
+                except Exception as e:
+                    if not self.loaded:
+                        raise
+                    if self.degraded_since is None:
+                        self.degraded_since = time.time()
+                    self.last_error = str(e)
+                    self.retry_at = time.monotonic() + self.retry_interval
+                else:
+                    self.degraded_since = None
+                    self.last_error = None
+                    self.retry_at = None
+                self._apply_deferred_locked()
+        self._apply_deferred()
+
+    def _refresh(self, loader, force, syncer):
+        if not force and syncer is not None and self.loaded and not self.reload_requested:
+            if syncer(self.codes):
+                self._mark_refreshed()
+                return
+        self.codes = loader()
+        self.loaded = True
+        self.reload_requested = False
+        self._mark_refreshed()
+
+    def restore(self, codes, on_restore=None):
+        """Serve codes from a snapshot until the first refresh, if nothing is loaded yet
+
+        on_restore() runs under the lock just before codes are installed.
+        """
+        with self._lock:
+            if self.loaded:
+                return False
+            if on_restore is not None:
+                on_restore()
+            self.codes = codes
+            self.loaded = True
+            self.version += 1
+            return True
+
+    def snapshot_view(self, sync_state):
+        """Get (codes, version, sync_state()) taken together, for saving a snapshot"""
+        # Under the lock no refresh is part-way through, and with queued
+        # updates applied the codes are at least as new as the sync state
+        with self._lock:
+            self._apply_deferred_locked()
+            return self.codes, self.version, sync_state()
+
+    def _mark_refreshed(self):
+        self.loaded_at = time.monotonic()
+        self.refreshed_at = time.time()
+        self.version += 1
+
+    def invalidate(self):
+        """Force the next get_codes() call to fully reload from the sheet"""
+        # Set straight away rather than waiting on a refresh that holds the
+        # lock, and queued too so that refresh can't clear it when it ends
+        self.loaded_at = None
+        self.reload_requested = True
+        self._update(('invalidate', ()))
+
+    # Write-through updates after our own writes. The store only ever grows
+    # in place and iterates by slot, so sessions reading it concurrently are
+    # safe; clear() and remove_codes() swap in a new store rather than shrink it.
+    # A refresh can hold the lock for as long as storage takes to answer, so
+    # rather than wait, updates are queued and applied once it finishes.
+
+    def lock_for(self, code):
+        """Get the lock that serializes writes to a single code"""
+        return self._code_locks[hash(code) % CODE_LOCK_STRIPES]
+
+    def locks_for(self, codes_list):
+        """Get the locks for many codes, each once, in the order they must be taken"""
+        stripes = sorted({hash(code) % CODE_LOCK_STRIPES for code in codes_list})
+        return [self._code_locks[stripe] for stripe in stripes]
+
+    def _update(self, update):
+        self._deferred.append(update)
+        self._apply_deferred()
+
+    def _apply_deferred(self):
+        # Whoever holds the lock applies the queue before releasing it and
+        # tries again straight after, so nothing queued is left behind
+        while self._deferred and self._lock.acquire(blocking=False):
+            try:
+                self._apply_deferred_locked()
+            finally:
+                self._lock.release()
+
+    def _apply_deferred_locked(self):
+        changed = False
+        while self._deferred:
+            kind, args = self._deferred.popleft()
+            if not self.loaded:
+                continue
+            if kind == 'invalidate':
+                self.loaded_at = None
+                self.reload_requested = True
+            elif kind == 'clear':
+                self.codes = CompactCodeStore()
+            elif kind == 'remove':
+                self.codes = self.codes.without(set(args[0]))
+            elif kind == 'add':
+                codes_list, deal = args
+                for code in codes_list:
+                    # A refresh may already have picked the code up from storage
+                    if code not in self.codes:
+                        self.codes.add(code, deal)
+            else:
+                code, redeemed, redeemed_at = args
+                if code not in self.codes:
+                    continue
+                self.codes.set_status(code, redeemed, redeemed_at)
+            changed = True
+        if changed:
+            self.version += 1
+
+    def redeem(self, storage, code, redeemed_at):
+        """Redeem code through storage if the index shows it unredeemed, returning the outcome"""
+        # Serialize redeemers of the same code within this process
+        with self.lock_for(code):
+            cached = self.get_codes(storage.load_codes, syncer=storage.sync_codes).get(code)
+            if cached is None:
+                return UNKNOWN_CODE
+            if cached['redeemed']:
+                return ALREADY_REDEEMED
+
+            change_log = self.change_log
+            if change_log is not None:
+                # Another process on this host may be redeeming the same code
+                claimed_at = change_log.claim(code, redeemed_at)
+                if claimed_at is not None:
+                    self.set_status(code, True, claimed_at)
+                    return ALREADY_REDEEMED
+
+            try:
+                outcome, redeemed_at = storage.redeem_code(code, redeemed_at, verify_row=not self.is_fresh())
+            except Exception:
+                if change_log is not None:
+                    change_log.release(code)
+                raise
+            if outcome == UNKNOWN_CODE:
+                if change_log is not None:
+                    change_log.release(code)
+            else:
+                self.set_status(code, True, redeemed_at)
+            return outcome
+
+    def _publish(self, kind, args):
+        if self.change_log is not None:
+            self.change_log.publish(kind, args)
+
+    def apply_shared_changes(self):
+        """Apply changes other processes have published since the last check"""
+        if self.change_log is None or not self.loaded:
+            return
+        for kind, args in self.change_log.poll():
+            if kind == RELOAD:
+                self.invalidate()
+                continue
+            self._update((kind, args))
+            if kind in ('remove', 'clear'):
+                # Rows moved up in the sheet, so row numbers storage holds are
+                # stale. Until the reload rebuilds them, treat the index as
+                # stale too so every write checks its row first.
+                self.invalidate()
+
+    def add_codes(self, codes_list, deal=''):
+        """Record newly saved codes"""
+        codes_list = list(codes_list)
+        self._publish('add', (codes_list, deal))
+        self._update(('add', (codes_list, deal)))
+
+    def set_status(self, code, redeemed, redeemed_at=''):
+        """Record a redemption or reinvocation of a single code"""
+        self._publish('status', (code, redeemed, redeemed_at))
+        self._update(('status', (code, redeemed, redeemed_at)))
+
+    def remove_codes(self, codes_list):
+        """Record that some codes were deleted"""
+        codes_list = list(codes_list)
+        self._publish('remove', (codes_list,))
+        self._update(('remove', (codes_list,)))
+
+    def clear(self):
+        """Record that every code was deleted"""
+        self._publish('clear', ())
+        with self._lock:
+            self._deferred.clear()
+            self.codes = CompactCodeStore()
+            self.loaded = True
+            self.loaded_at = time.monotonic()
+            self.version += 1
@@ -0,0 +1,576 @@
+import threading
+from array import array
+from collections import Counter
+from collections.abc import Mapping
+from datetime import datetime, timezone
+from itertools import islice
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Redemptions are counted per hour of their Redeemed At time
+STATS_BUCKET_SECONDS = 3600
+
+
+def _pack_timestamp(value):
+    """Convert a Redeemed At string to integer seconds, or None if it won't round-trip"""
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        return None
+    seconds = int(parsed.replace(tzinfo=timezone.utc).timestamp())
+    return seconds if _unpack_timestamp(seconds) == value else None
+
+
+def _unpack_timestamp(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
+class CompactCodeStore(Mapping):
+    """Columnar code table that reads like the old dict of code -> record dicts
+
+    Each code gets a slot number. Deals are interned to small integer IDs,
+    redemption status is one bit per code and timestamps are integer seconds,
+    so a code costs a string plus a few bytes instead of a dict of strings.
+    """
+
+    def __init__(self):
+        self.codes = []                 # slot -> code
+        self.slots = {}                 # code -> slot
+        self.deals = ['']               # deal ID -> deal text
+        self.deal_ids = {'': 0}         # deal text -> deal ID
+        self.deal_column = array('I')   # slot -> deal ID
+        self.redeemed_bits = bytearray()
+        self.redeemed_at_column = array('q')  # slot -> seconds, 0 when blank
+        # Timestamps typed into the sheet by hand that don't fit the usual
+        # format are kept verbatim so nothing is lost
+        self.raw_redeemed_at = {}
+        # Secondary indexes, built on first use and dropped when codes are added
+        self._query_index = None
+        # Bumped whenever the query index is dropped, so one built meanwhile isn't kept
+        self.layout_changes = 0
+        # Slots whose status changed while the query index was being built
+        self._changed_slots = None
+        self._query_index_lock = threading.Lock()
+        # Running totals, built on first use and kept current from then on
+        self._stats = None
+        # Held by every change to the columns, so the totals are counted from
+        # a table that isn't changing underneath them
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_columns(cls, codes, deals, deal_column, redeemed_bits, redeemed_at_column, raw_redeemed_at=None):
+        """Build a store straight from its columns, as saved by a snapshot"""
+        store = cls()
+        store.codes = codes
+        store.slots = dict(zip(codes, range(len(codes))))
+        store.deals = deals
+        store.deal_ids = {deal: deal_id for deal_id, deal in enumerate(deals)}
+        store.deal_column = deal_column
+        store.redeemed_bits = redeemed_bits
+        store.redeemed_at_column = redeemed_at_column
+        store.raw_redeemed_at = raw_redeemed_at or {}
+        return store
+
+    def without(self, removed):
+        """Copy the store leaving out the codes in the set removed"""
+        keep = [slot for slot, code in enumerate(self.codes) if code not in removed]
+        redeemed_bits = bytearray((len(keep) + 7) // 8)
+        for new_slot, slot in enumerate(keep):
+            if self.is_redeemed(slot):
+                redeemed_bits[new_slot >> 3] |= 1 << (new_slot & 7)
+        store = CompactCodeStore.from_columns(
+            [self.codes[slot] for slot in keep],
+            list(self.deals),
+            array('I', (self.deal_column[slot] for slot in keep)),
+            redeemed_bits,
+            array('q', (self.redeemed_at_column[slot] for slot in keep)),
+            {new_slot: self.raw_redeemed_at[slot] for new_slot, slot in enumerate(keep) if slot in self.raw_redeemed_at}
+        )
+        if self._stats is not None:
+            # Take the removed codes off the totals rather than counting again
+            stats = store._stats = self._stats.copy()
+            stats.deals = store.deals
+            for code in removed:
+                slot = self.slots.get(code)
+                if slot is not None:
+                    stats.remove_code(self.deal_column[slot], self.is_redeemed(slot), self.redeemed_at_column[slot])
+        return store
+
+    def intern_deal(self, deal):
+        """Get the small integer ID for a deal, assigning one if it is new"""
+        deal_id = self.deal_ids.get(deal)
+        if deal_id is None:
+            deal_id = self.deal_ids[deal] = len(self.deals)
+            self.deals.append(deal)
+        return deal_id
+
+    def add(self, code, deal='', redeemed=False, redeemed_at=''):
+        """Add a code, or overwrite it if it is already stored"""
+        with self._lock:
+            deal_id = self.intern_deal(deal)
+            slot = self.slots.get(code)
+            if slot is not None:
+                if self.deal_column[slot] != deal_id:
+                    if self._stats is not None:
+                        self._stats.move_code(
+                            self.deal_column[slot], deal_id, self.is_redeemed(slot), self.redeemed_at_column[slot]
+                        )
+                    self.deal_column[slot] = deal_id
+                    self.layout_changes += 1
+                    self._query_index = None
+                self._set_status(slot, redeemed, redeemed_at)
+                return
+
+            slot = len(self.codes)
+            if slot % 8 == 0:
+                self.redeemed_bits.append(0)
+            self.deal_column.append(deal_id)
+            self.redeemed_at_column.append(0)
+            if self._stats is not None:
+                self._stats.add_code(deal_id)
+            self._set_status(slot, redeemed, redeemed_at)
+            # Publish the code last so concurrent readers never see a half-added slot
+            self.codes.append(code)
+            self.slots[code] = slot
+            self.layout_changes += 1
+            self._query_index = None
+
+    def set_status(self, code, redeemed, redeemed_at=''):
+        """Set the redemption status of a stored code"""
+        with self._lock:
+            self._set_status(self.slots[code], redeemed, redeemed_at)
+
+    def _set_status(self, slot, redeemed, redeemed_at):
+        was_redeemed = self.is_redeemed(slot)
+        if redeemed:
+            self.redeemed_bits[slot >> 3] |= 1 << (slot & 7)
+        else:
+            self.redeemed_bits[slot >> 3] &= ~(1 << (slot & 7)) & 0xFF
+        # Record the change for a query index being built before looking
+        # for a finished one, so one of the two always sees it
+        changed_slots = self._changed_slots
+        if changed_slots is not None:
+            changed_slots.append(slot)
+        query_index = self._query_index
+        if query_index is not None:
+            query_index.set_redeemed(slot, redeemed)
+
+        seconds = _pack_timestamp(redeemed_at) if redeemed_at else 0
+        if seconds is None:
+            self.raw_redeemed_at[slot] = redeemed_at
+            seconds = 0
+        else:
+            self.raw_redeemed_at.pop(slot, None)
+        stats = self._stats
+        if stats is not None:
+            stats.set_status(self.deal_column[slot], was_redeemed, self.redeemed_at_column[slot], redeemed, seconds)
+        self.redeemed_at_column[slot] = seconds
+
+    def is_redeemed(self, slot):
+        """Check the redeemed bit of a slot"""
+        return bool(self.redeemed_bits[slot >> 3] & (1 << (slot & 7)))
+
+    def deal_of(self, slot):
+        """Get the deal text of a slot"""
+        return self.deals[self.deal_column[slot]]
+
+    def redeemed_at_of(self, slot):
+        """Get the Redeemed At text of a slot"""
+        seconds = self.redeemed_at_column[slot]
+        if seconds:
+            return _unpack_timestamp(seconds)
+        return self.raw_redeemed_at.get(slot, '')
+
+    def record(self, slot):
+        """Build the record dict the UI expects for a slot"""
+        return {
+            'code': self.codes[slot],
+            'deal': self.deal_of(slot),
+            'redeemed': self.is_redeemed(slot),
+            'redeemed_at': self.redeemed_at_of(slot)
+        }
+
+    def query_index(self):
+        """Get the secondary indexes for filtering and paging, building them if needed
+
+        Redemptions don't wait for the build. Their slots are recorded while
+        it runs and set from the table once it is done. If codes were added
+        meanwhile, the index is handed out but not kept.
+        """
+        query_index = self._query_index
+        if query_index is not None:
+            return query_index
+        with self._query_index_lock:
+            query_index = self._query_index
+            if query_index is not None:
+                return query_index
+            layout_changes = self.layout_changes
+            changed_slots = self._changed_slots = []
+            try:
+                built = CodeQueryIndex(self)
+                if layout_changes == self.layout_changes:
+                    self._query_index = built
+            finally:
+                self._changed_slots = None
+            built.refresh_redeemed(changed_slots)
+        return built
+
+    def stats(self):
+        """Get the running totals, per-deal counts and redemptions per hour, building them if needed"""
+        stats = self._stats
+        if stats is None:
+            with self._lock:
+                stats = self._stats
+                if stats is None:
+                    stats = self._stats = CodeStats(self, len(self.codes))
+        return stats
+
+    # Mapping interface - records are built on demand
+
+    def __getitem__(self, code):
+        return self.record(self.slots[code])
+
+    def __contains__(self, code):
+        return code in self.slots
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        # Iterate over slots rather than the dict so codes added meanwhile
+        # by another session can't break the loop
+        for slot in range(len(self.codes)):
+            yield self.codes[slot]
+
+    def values(self):
+        return (self.record(slot) for slot in range(len(self.codes)))
+
+    def items(self):
+        return ((self.codes[slot], self.record(slot)) for slot in range(len(self.codes)))
+
+
+class CodeQueryIndex:
+    """Secondary indexes over a CompactCodeStore for admin filtering, search and paging
+
+    Codes are ranked in sorted order. Status and deal filters are bitmaps over
+    those ranks, held as Python ints so combining them is a single AND, and
+    search uses a trigram index filled in as trigrams are first searched for.
+    A page is then read straight out of the matching ranks without touching
+    the rest of the table.
+    """
+
+    # Bytes of a bitmap counted at once while skipping to the start of a page
+    PAGE_SCAN_BLOCK = 512
+
+    # Distinct searches remembered before the cache is cleared
+    SEARCH_CACHE_SIZE = 64
+
+    def __init__(self, store):
+        self.store = store
+        self.size = size = len(store.codes)
+        codes = store.codes
+
+        self.sorted_slots = array('I', sorted(range(size), key=codes.__getitem__))
+        self.rank_of = array('I', bytes(4 * size))
+
+        redeemed = bytearray((size + 7) // 8)
+        deals = {}
+        for rank, slot in enumerate(self.sorted_slots):
+            self.rank_of[slot] = rank
+            bit = 1 << (rank & 7)
+            if store.is_redeemed(slot):
+                redeemed[rank >> 3] |= bit
+            deal_id = store.deal_column[slot]
+            deal_bits = deals.get(deal_id)
+            if deal_bits is None:
+                deal_bits = deals[deal_id] = bytearray(len(redeemed))
+            deal_bits[rank >> 3] |= bit
+
+        self.all_mask = (1 << size) - 1
+        self.redeemed_mask = int.from_bytes(redeemed, 'little')
+        self.deal_masks = {deal_id: int.from_bytes(bits, 'little') for deal_id, bits in deals.items()}
+        self.trigrams = {}
+        self._search_cache = {}
+        self._lock = threading.Lock()
+
+    def set_redeemed(self, slot, redeemed):
+        """Keep the status bitmap current when a code is redeemed or reinvoked"""
+        if slot >= self.size:
+            return
+        bit = 1 << self.rank_of[slot]
+        with self._lock:
+            if redeemed:
+                self.redeemed_mask |= bit
+            else:
+                self.redeemed_mask &= ~bit
+
+    def refresh_redeemed(self, slots):
+        """Set the status bits of slots from the store, for changes made while the index was built"""
+        # A set_redeemed() waiting on the lock is newer than what the store
+        # shows here, so it can only land afterwards
+        with self._lock:
+            for slot in slots:
+                if slot < self.size:
+                    bit = 1 << self.rank_of[slot]
+                    if self.store.is_redeemed(slot):
+                        self.redeemed_mask |= bit
+                    else:
+                        self.redeemed_mask &= ~bit
+
+    def trigram_posting(self, gram):
+        """Get the slots of codes containing a trigram"""
+        posting = self.trigrams.get(gram)
+        if posting is None:
+            # Indexing every trigram up front costs seconds on large tables,
+            # so each one is found with a single scan the first time it is used
+            codes = self.store.codes
+            posting = self.trigrams[gram] = array('I', (
+                slot for slot in range(self.size) if gram in codes[slot]
+            ))
+        return posting
+
+    def search_ranks(self, query):
+        """Get the sorted ranks of codes containing query"""
+        ranks = self._search_cache.get(query)
+        if ranks is not None:
+            return ranks
+
+        codes = self.store.codes
+        if len(query) < 3:
+            # Too short for trigrams - one pass over the table, then cached
+            ranks = [rank for rank, slot in enumerate(self.sorted_slots) if query in codes[slot]]
+        else:
+            grams = [query[i:i + 3] for i in range(len(query) - 2)]
+            # Intersect the trigrams already indexed, rarest first, or index
+            # just the first one. Each candidate is then confirmed, since
+            # sharing trigrams doesn't guarantee the whole query matches.
+            postings = sorted((self.trigrams[gram] for gram in grams if gram in self.trigrams), key=len)
+            if not postings:
+                postings = [self.trigram_posting(grams[0])]
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                if len(candidates) < 64:
+                    break
+                candidates.intersection_update(posting)
+            ranks = sorted(self.rank_of[slot] for slot in candidates if query in codes[slot])
+
+        if len(self._search_cache) >= self.SEARCH_CACHE_SIZE:
+            self._search_cache.clear()
+        self._search_cache[query] = ranks
+        return ranks
+
+    def query(self, redeemed=None, deal=None, search=''):
+        """Filter by status (None for any), deal (None for any) and code substring"""
+        mask = None
+        if redeemed is True:
+            mask = self.redeemed_mask
+        elif redeemed is False:
+            mask = self.all_mask & ~self.redeemed_mask
+
+        if deal is not None:
+            deal_mask = self.deal_masks.get(self.store.deal_ids.get(deal), 0)
+            mask = deal_mask if mask is None else mask & deal_mask
+
+        if search:
+            ranks = self.search_ranks(search)
+            if mask is not None:
+                bits = mask.to_bytes((self.size + 7) // 8, 'little')
+                ranks = [rank for rank in ranks if bits[rank >> 3] & (1 << (rank & 7))]
+            return CodeQueryResult(self, ranks=ranks)
+        return CodeQueryResult(self, mask=mask)
+
+
+class CodeQueryResult:
+    """Codes matching a query, in code order, read one page at a time"""
+
+    def __init__(self, index, mask=None, ranks=None):
+        self.index = index
+        self.mask = mask
+        self.ranks = ranks
+        if ranks is not None:
+            self.count = len(ranks)
+        elif mask is not None:
+            self.count = mask.bit_count()
+        else:
+            self.count = index.size
+
+    def page_ranks(self, start, size):
+        """Get the ranks of matches start to start + size"""
+        if self.ranks is not None:
+            return self.ranks[start:start + size]
+        if self.mask is None:
+            return range(start, min(start + size, self.index.size))
+
+        bits = self.mask.to_bytes((self.index.size + 7) // 8, 'little')
+        block_size = CodeQueryIndex.PAGE_SCAN_BLOCK
+        ranks = []
+        seen = 0
+        for offset in range(0, len(bits), block_size):
+            block = bits[offset:offset + block_size]
+            count = int.from_bytes(block, 'little').bit_count()
+            # Skip whole blocks that end before the page starts
+            if seen + count <= start:
+                seen += count
+                continue
+            for byte_offset, byte in enumerate(block, start=offset):
+                while byte:
+                    low_bit = byte & -byte
+                    if seen >= start:
+                        ranks.append(byte_offset * 8 + low_bit.bit_length() - 1)
+                        if len(ranks) == size:
+                            return ranks
+                    seen += 1
+                    byte ^= low_bit
+        return ranks
+
+    def page(self, start, size):
+        """Get (code, record) pairs for matches start to start + size"""
+        store = self.index.store
+        sorted_slots = self.index.sorted_slots
+        return [(store.codes[slot], store.record(slot)) for slot in (sorted_slots[rank] for rank in self.page_ranks(start, size))]
+
+    def iter_ranks(self):
+        """Yield the rank of every match in order, in a single pass"""
+        if self.ranks is not None:
+            yield from self.ranks
+        elif self.mask is None:
+            yield from range(self.index.size)
+        else:
+            for byte_offset, byte in enumerate(self.mask.to_bytes((self.index.size + 7) // 8, 'little')):
+                while byte:
+                    low_bit = byte & -byte
+                    yield byte_offset * 8 + low_bit.bit_length() - 1
+                    byte ^= low_bit
+
+    def iter_pages(self, size):
+        """Yield every match as successive pages of (code, record) pairs"""
+        store = self.index.store
+        sorted_slots = self.index.sorted_slots
+        ranks = self.iter_ranks()
+        while True:
+            page_ranks = list(islice(ranks, size))
+            if not page_ranks:
+                return
+            yield [(store.codes[slot], store.record(slot)) for slot in (sorted_slots[rank] for rank in page_ranks)]
+
+
+class CodeStats:
+    """Totals, per-deal counts and redemptions per hour of a CompactCodeStore
+
+    Counted once from the store's columns, then kept current by the store on
+    every add, status change and delete, so reading them never scans codes.
+    """
+
+    def __init__(self, store=None, size=0):
+        self.deals = store.deals if store is not None else ['']
+        self.total = 0
+        self.redeemed = 0
+        self.deal_totals = []        # deal ID -> codes
+        self.deal_redeemed = []      # deal ID -> redeemed codes
+        self.redemptions = {}        # hour start in seconds -> codes redeemed in that hour
+        if store is None:
+            return
+
+        self.total = size
+        self._grow(len(store.deals) - 1)
+        for deal_id, count in Counter(store.deal_column[:size]).items():
+            self._grow(deal_id)
+            self.deal_totals[deal_id] = count
+        # Only redeemed slots are visited, a byte of the bitset at a time
+        for byte_index, byte in enumerate(store.redeemed_bits[:(size + 7) // 8]):
+            if not byte:
+                continue
+            for bit in range(8):
+                slot = (byte_index << 3) | bit
+                if byte & (1 << bit) and slot < size:
+                    self._count_redemption(store.deal_column[slot], store.redeemed_at_column[slot], 1)
+
+    def copy(self):
+        """Copy the totals, e.g. for a store rebuilt without some codes"""
+        stats = CodeStats()
+        stats.deals = self.deals
+        stats.total = self.total
+        stats.redeemed = self.redeemed
+        stats.deal_totals = list(self.deal_totals)
+        stats.deal_redeemed = list(self.deal_redeemed)
+        stats.redemptions = dict(self.redemptions)
+        return stats
+
+    def _grow(self, deal_id):
+        while len(self.deal_totals) <= deal_id:
+            self.deal_totals.append(0)
+            self.deal_redeemed.append(0)
+
+    def _count_redemption(self, deal_id, seconds, amount):
+        self._grow(deal_id)
+        self.redeemed += amount
+        self.deal_redeemed[deal_id] += amount
+        # Hand-typed timestamps that can't be parsed count only towards the totals
+        if seconds:
+            bucket = seconds - seconds % STATS_BUCKET_SECONDS
+            count = self.redemptions.get(bucket, 0) + amount
+            if count:
+                self.redemptions[bucket] = count
+            else:
+                del self.redemptions[bucket]
+
+    def add_code(self, deal_id):
+        """Count a new, unredeemed code"""
+        self._grow(deal_id)
+        self.total += 1
+        self.deal_totals[deal_id] += 1
+
+    def remove_code(self, deal_id, redeemed, seconds):
+        """Take a deleted code off the totals"""
+        self._grow(deal_id)
+        self.total -= 1
+        self.deal_totals[deal_id] -= 1
+        if redeemed:
+            self._count_redemption(deal_id, seconds, -1)
+
+    def move_code(self, old_deal_id, new_deal_id, redeemed, seconds):
+        """Move a code's counts to another deal"""
+        self.remove_code(old_deal_id, redeemed, seconds)
+        self.add_code(new_deal_id)
+        if redeemed:
+            self._count_redemption(new_deal_id, seconds, 1)
+
+    def set_status(self, deal_id, was_redeemed, old_seconds, redeemed, seconds):
+        """Count a redemption, reinvocation or change of Redeemed At"""
+        if was_redeemed:
+            self._count_redemption(deal_id, old_seconds, -1)
+        if redeemed:
+            self._count_redemption(deal_id, seconds, 1)
+
+    @property
+    def available(self):
+        return self.total - self.redeemed
+
+    def deal_names(self):
+        """Get the sorted, non-empty deals that have at least one code"""
+        return sorted(
+            self.deals[deal_id] for deal_id, count in enumerate(self.deal_totals) if count and self.deals[deal_id]
+        )
+
+    def by_deal(self):
+        """Get (deal, total, available, redeemed) for every deal with codes, sorted by deal"""
+        rows = []
+        for deal_id, total in enumerate(self.deal_totals):
+            if total:
+                redeemed = self.deal_redeemed[deal_id]
+                rows.append((self.deals[deal_id], total, total - redeemed, redeemed))
+        return sorted(rows)
+
+    def redemptions_per_hour(self, since=None):
+        """Get (hour, redemptions) in time order, optionally only for hours from a Redeemed At time on"""
+        start = 0
+        if since is not None:
+            start = _pack_timestamp(since) or 0
+            start -= start % STATS_BUCKET_SECONDS
+        return [
+            (_unpack_timestamp(bucket), count)
+            for bucket, count in sorted(self.redemptions.items())
+            if bucket >= start
+        ]
@@ -0,0 +1,186 @@
+import hashlib
+import os
+import re
+import string
+
+ALPHABET = string.ascii_uppercase + string.digits
+CODE_SPACE = len(ALPHABET) ** 8
+
+# Each half of a code (XXXX) is one Feistel half
+HALF_SPACE = len(ALPHABET) ** 4
+FEISTEL_ROUNDS = 8
+
+# Codes with a check character are XXXX-XXXX-C, where C is a Luhn mod 36
+# check character over the eight characters of the XXXX-XXXX body
+BODY_LENGTH = 9
+CHECKED_CODE_PATTERN = re.compile(r'[A-Z0-9]{4}-[A-Z0-9]{4}-[A-Z0-9]')
+_CHAR_VALUES = {char: value for value, char in enumerate(ALPHABET)}
+
+# Codes are drawn from 6 random bytes each. Values at or above this bound are
+# rejected so that reducing modulo CODE_SPACE stays uniform.
+_RAW_BOUND = (256 ** 6 // CODE_SPACE) * CODE_SPACE
+
+
+def check_character(body):
+    """Get the Luhn mod 36 check character of an XXXX-XXXX code body
+
+    Catches any single mistyped character and almost every swap of two
+    neighbouring ones, including with the check character itself.
+    """
+    base = len(ALPHABET)
+    total = 0
+    # Double every other character, starting from the rightmost
+    for position, char in enumerate(reversed(body.replace('-', ''))):
+        value = _CHAR_VALUES[char]
+        if position % 2 == 0:
+            value = sum(divmod(value * 2, base))
+        total += value
+    return ALPHABET[-total % base]
+
+
+def has_valid_check_character(code):
+    """Check a code could exist before looking it up
+
+    False only for codes in the XXXX-XXXX-C format whose check character is
+    wrong, i.e. typos. Codes in any other format, such as XXXX-XXXX codes
+    issued before check characters were enabled, have to be looked up.
+    """
+    if not CHECKED_CODE_PATTERN.fullmatch(code):
+        return True
+    return check_character(code[:BODY_LENGTH]) == code[-1]
+
+
+def format_code(value, checked=False):
+    """Format an integer in [0, CODE_SPACE) as an XXXX-XXXX code, or XXXX-XXXX-C if checked"""
+    chars = []
+    for _ in range(8):
+        value, digit = divmod(value, len(ALPHABET))
+        chars.append(ALPHABET[digit])
+    code = ''.join(chars[:4]) + '-' + ''.join(chars[4:])
+    if checked:
+        code += '-' + check_character(code)
+    return code
+
+
+def is_taken(code, existing_codes):
+    """Check whether a new code, or an older code without its check character, already exists"""
+    return code in existing_codes or (len(code) > BODY_LENGTH and code[:BODY_LENGTH] in existing_codes)
+
+
+def generate_code(checked=False):
+    """Generate a random 8-character alphanumeric code in format XXXX-XXXX, plus a check character if checked"""
+    return generate_code_batch(1, checked)[0]
+
+
+def generate_code_batch(count, checked=False):
+    """Generate count random codes (duplicates possible) from the OS CSPRNG"""
+    codes = []
+    while len(codes) < count:
+        # One urandom call per batch instead of one per character
+        raw = os.urandom((count - len(codes)) * 6)
+        for offset in range(0, len(raw), 6):
+            value = int.from_bytes(raw[offset:offset + 6], 'big')
+            if value < _RAW_BOUND:
+                codes.append(format_code(value % CODE_SPACE, checked))
+    return codes
+
+
+def iter_unique_code_chunks(num_codes, existing_codes, chunk_size, checked=False):
+    """Yield lists of up to chunk_size new codes, num_codes in total, none in existing_codes"""
+    seen = set()
+    chunk = []
+    produced = 0
+    stalled_batches = 0
+
+    while produced < num_codes:
+        batch = generate_code_batch(min(chunk_size, num_codes - produced), checked)
+        added = 0
+        for code in batch:
+            if code in seen or is_taken(code, existing_codes):
+                continue
+            seen.add(code)
+            chunk.append(code)
+            added += 1
+            produced += 1
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+
+        # Give up rather than spin forever once the code space is exhausted
+        stalled_batches = stalled_batches + 1 if added == 0 else 0
+        if stalled_batches >= 100:
+            break
+
+    if chunk:
+        yield chunk
+
+
+def generate_unique_codes(num_codes, existing_codes, checked=False):
+    """Generate unique codes that don't already exist"""
+    new_codes = []
+    for chunk in iter_unique_code_chunks(num_codes, existing_codes, num_codes, checked):
+        new_codes.extend(chunk)
+    return new_codes
+
+
+class CodePermutation:
+    """Secret keyed bijection on [0, CODE_SPACE) used to turn a counter into a code"""
+
+    def __init__(self, key):
+        if isinstance(key, str):
+            key = key.encode()
+        # blake2b takes keys of up to 64 bytes - normalise whatever we were given
+        key = hashlib.sha256(key).digest()
+        # Keyed hash states primed with the round number, copied for each call
+        self._round_hashes = []
+        for round_num in range(FEISTEL_ROUNDS):
+            round_hash = hashlib.blake2b(key=key, digest_size=8)
+            round_hash.update(round_num.to_bytes(1, 'big'))
+            self._round_hashes.append(round_hash)
+
+    def _round(self, round_num, half):
+        round_hash = self._round_hashes[round_num].copy()
+        round_hash.update(half.to_bytes(4, 'big'))
+        return int.from_bytes(round_hash.digest(), 'big') % HALF_SPACE
+
+    def encrypt(self, value):
+        """Map a counter value to its permuted value"""
+        # Balanced Feistel network with addition mod 36^4, so every output is
+        # another value in the code space and no cycle walking is needed
+        left, right = divmod(value, HALF_SPACE)
+        for round_num in range(FEISTEL_ROUNDS):
+            left, right = right, (left + self._round(round_num, right)) % HALF_SPACE
+        return left * HALF_SPACE + right
+
+    def decrypt(self, value):
+        """Map a permuted value back to its counter value"""
+        left, right = divmod(value, HALF_SPACE)
+        for round_num in reversed(range(FEISTEL_ROUNDS)):
+            left, right = (right - self._round(round_num, left)) % HALF_SPACE, left
+        return left * HALF_SPACE + right
+
+    def code_for(self, counter, checked=False):
+        """Get the code allocated to a counter value"""
+        return format_code(self.encrypt(counter), checked)
+
+
+def iter_allocated_code_chunks(permutation, reserve, num_codes, chunk_size, skip_codes=(), checked=False):
+    """Yield chunks of codes allocated from counter ranges handed out by reserve(count)"""
+    produced = 0
+    while produced < num_codes:
+        count = min(chunk_size, num_codes - produced)
+        start = reserve(count)
+        if start + count > CODE_SPACE:
+            raise ValueError("The code space is exhausted")
+
+        # Distinct counters always give distinct codes. skip_codes only guards
+        # against randomly generated codes issued before the allocator was enabled.
+        chunk = []
+        for counter in range(start, start + count):
+            code = permutation.code_for(counter, checked)
+            if not is_taken(code, skip_codes):
+                chunk.append(code)
+
+        produced += len(chunk)
+        if chunk:
+            yield chunk
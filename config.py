@@ -0,0 +1,108 @@
+import streamlit as st
+
+from code_index import CodeIndex
+from codegen import CodePermutation
+from journal import RedemptionJournal, JournaledStorage
+from shared_cache import SharedChangeLog
+from sheets_client import SheetsConnection
+from sheets_scheduler import SheetsScheduler
+from storage import SheetsStorage, SQLiteStorage, FakeWorksheet
+from throttle import ClientThrottle, ATTEMPTS_PER_MINUTE, INVALID_ATTEMPTS_PER_MINUTE
+
+# Settings and backend setup shared by the Streamlit app and the JSON API,
+# so both read the same secrets the same way
+
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
+# Seconds the shared code index is trusted before it is reloaded from the sheet
+CODE_CACHE_TTL = 300
+
+# Worksheet holding the code allocator's counter, created when code_key is set
+COUNTER_SHEET = 'Allocator'
+
+# Worksheet codes of retired deals are copied to before they are deleted
+ARCHIVE_SHEET = 'Archive'
+
+# Default redemption journals of the app and the API
+JOURNAL_PATH = 'redemptions.db'
+API_JOURNAL_PATH = 'api_redemptions.db'
+
+
+def get_secret(key, default=None):
+    """Read an optional value from Streamlit secrets"""
+    try:
+        return st.secrets[key]
+    except Exception:
+        return default
+
+
+def get_storage_backend():
+    """Name of the storage backend selected in secrets"""
+    return get_secret("storage_backend", "sheets")
+
+
+def open_code_index():
+    """Code index for one process, sharing changes through shared_cache_path when set"""
+    # With several processes on one host, they see each other's changes
+    # through a shared change log instead of waiting for the next sync
+    shared_cache_path = get_secret("shared_cache_path")
+    change_log = SharedChangeLog(shared_cache_path) if shared_cache_path else None
+    return CodeIndex(ttl=CODE_CACHE_TTL, change_log=change_log)
+
+
+def open_client_throttle():
+    """Limits on code checks and redemptions per client"""
+    return ClientThrottle(
+        attempts_per_minute=int(get_secret("check_attempts_per_minute", ATTEMPTS_PER_MINUTE)),
+        invalid_per_minute=int(get_secret("invalid_codes_per_minute", INVALID_ATTEMPTS_PER_MINUTE))
+    )
+
+
+def open_code_permutation():
+    """Keyed permutation for allocating codes, or None to generate them at random"""
+    code_key = get_secret("code_key")
+    return CodePermutation(code_key) if code_key else None
+
+
+def open_sheets_connection(allocator=False):
+    """Google Sheets connection, opened on first use"""
+    return SheetsConnection(
+        st.secrets["gcp_service_account"],
+        st.secrets["spreadsheet_url"],
+        SCOPES,
+        # The code allocator keeps its counter on its own worksheet
+        counter_title=COUNTER_SHEET if allocator else None,
+        archive_title=ARCHIVE_SHEET
+    )
+
+
+def open_storage(backend, index, journal_path=None, connection=None, scheduler=None, memory_worksheets=None):
+    """Open a storage backend by name
+
+    The sheets backend uses connection and scheduler, or new ones, and
+    journals redemptions when journal_path is given. memory_worksheets are
+    the (codes, counter, archive) worksheets of the memory backend.
+    """
+    if backend == "sqlite":
+        return SQLiteStorage(get_secret("sqlite_path", "codes.db"))
+    if backend == "memory":
+        # Offline demo/testing - codes live only as long as the process
+        worksheet, counter_worksheet, archive_worksheet = memory_worksheets or (
+            FakeWorksheet(), FakeWorksheet(), FakeWorksheet()
+        )
+        return SheetsStorage(worksheet, counter_worksheet, archive_worksheet=archive_worksheet)
+    # Nothing is sent to Google until the codes are first needed
+    if connection is None:
+        connection = open_sheets_connection()
+    if scheduler is None:
+        scheduler = SheetsScheduler(on_auth_error=connection.reset)
+    storage = SheetsStorage(connection=connection, scheduler=scheduler)
+    if journal_path:
+        # Redemptions are confirmed once journaled locally and written to the
+        # sheet in the background
+        return JournaledStorage(storage, RedemptionJournal(journal_path), is_fresh=index.is_fresh,
+                                is_degraded=index.is_degraded)
+    return storage
@@ -0,0 +1,48 @@
+import csv
+import io
+import json
+
+from storage import HEADERS
+
+# Codes formatted per chunk of output
+EXPORT_CHUNK_SIZE = 10_000
+
+# Format -> (MIME type, file extension)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson')
+}
+
+
+def _csv_chunk(page):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # Same columns and values as the sheet, so an export can be pasted back in
+    writer.writerows(
+        [code, data['deal'], 'TRUE' if data['redeemed'] else 'FALSE', data['redeemed_at']]
+        for code, data in page
+    )
+    return buffer.getvalue()
+
+
+def _ndjson_chunk(page):
+    return ''.join(json.dumps(data) + '\n' for _, data in page)
+
+
+def iter_export(codes, export_format='csv', redeemed=None, deal=None, search='', chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield codes matching the admin filters as CSV or NDJSON text, one chunk at a time
+
+    Codes are read page by page from the query index in code order, so only
+    one chunk is ever held in memory whatever the size of the table.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(HEADERS)
+        yield buffer.getvalue()
+
+    format_chunk = _csv_chunk if export_format == 'csv' else _ndjson_chunk
+    result = codes.query_index().query(redeemed=redeemed, deal=deal, search=search)
+    for page in result.iter_pages(chunk_size):
+        yield format_chunk(page)
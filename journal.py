@@ -0,0 +1,317 @@
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+
+from code_index import REDEEMED, ALREADY_REDEEMED
+from metrics import metrics
+from storage import CodeStorage
+
+# Seconds between pushes of journaled redemptions to storage
+FLUSH_INTERVAL = 2
+
+# Most redemptions written in one flush
+FLUSH_BATCH_SIZE = 5000
+
+logger = logging.getLogger(__name__)
+
+
+class RedemptionJournal:
+    """Durable local log of redemptions that have not reached storage yet
+
+    Entries live in a SQLite database in WAL mode with full fsync, so a
+    redemption survives a crash once append() returns. Entries are removed
+    once they have been written to storage. Redemptions found to clash with
+    one recorded in storage meanwhile are kept in a conflicts table for review.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=FULL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS redemptions ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, code TEXT NOT NULL, redeemed_at TEXT NOT NULL)'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS conflicts ('
+                'code TEXT NOT NULL, redeemed_at TEXT NOT NULL, stored_redeemed_at TEXT NOT NULL, '
+                'detected_at TEXT NOT NULL)'
+            )
+            # code -> (entry ID, redeemed at) of the latest pending entry,
+            # replayed from disk after a restart
+            self._pending = {
+                code: (entry_id, redeemed_at)
+                for entry_id, code, redeemed_at in self._conn.execute(
+                    'SELECT id, code, redeemed_at FROM redemptions ORDER BY id'
+                )
+            }
+
+    def __len__(self):
+        return len(self._pending)
+
+    def append(self, code, redeemed_at):
+        """Durably record a redemption, returning its entry ID"""
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO redemptions (code, redeemed_at) VALUES (?, ?)', (code, redeemed_at)
+            )
+            self._pending[code] = (cursor.lastrowid, redeemed_at)
+            return cursor.lastrowid
+
+    def pending_for(self, code):
+        """Get the Redeemed At of a pending redemption of code, or None"""
+        entry = self._pending.get(code)
+        return entry[1] if entry else None
+
+    def pending_items(self):
+        """Get (code, redeemed_at) for every pending redemption"""
+        with self._lock:
+            return [(code, redeemed_at) for code, (_, redeemed_at) in self._pending.items()]
+
+    def last_id(self):
+        """Get the ID of the newest entry, or 0 when there are none"""
+        with self._lock:
+            return max((entry_id for entry_id, _ in self._pending.values()), default=0)
+
+    def oldest(self, limit):
+        """Get up to limit of the oldest pending entries as (entry_id, code, redeemed_at)"""
+        with self._lock:
+            entries = sorted((entry_id, code, redeemed_at) for code, (entry_id, redeemed_at) in self._pending.items())
+        return entries[:limit]
+
+    def remove(self, codes, up_to_id):
+        """Drop the pending entries of codes, leaving any made after entry up_to_id"""
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN')
+                for code in codes:
+                    self._conn.execute('DELETE FROM redemptions WHERE code = ? AND id <= ?', (code, up_to_id))
+                    entry = self._pending.get(code)
+                    if entry and entry[0] <= up_to_id:
+                        del self._pending[code]
+
+    def clear(self):
+        """Drop every pending entry"""
+        with self._lock:
+            self._conn.execute('DELETE FROM redemptions')
+            self._pending = {}
+
+    def record_conflicts(self, conflicts):
+        """Keep (code, redeemed_at, stored_redeemed_at) for redemptions storage already had"""
+        detected_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN')
+                self._conn.executemany(
+                    'INSERT INTO conflicts (code, redeemed_at, stored_redeemed_at, detected_at) VALUES (?, ?, ?, ?)',
+                    [(code, redeemed_at, stored_redeemed_at, detected_at)
+                     for code, redeemed_at, stored_redeemed_at in conflicts]
+                )
+
+    def conflicts(self):
+        """Get the recorded conflicts as record dicts, oldest first"""
+        with self._lock:
+            return [
+                {'code': code, 'redeemed_at': redeemed_at, 'stored_redeemed_at': stored_redeemed_at,
+                 'detected_at': detected_at}
+                for code, redeemed_at, stored_redeemed_at, detected_at in self._conn.execute(
+                    'SELECT code, redeemed_at, stored_redeemed_at, detected_at FROM conflicts ORDER BY rowid'
+                )
+            ]
+
+    def clear_conflicts(self):
+        """Forget every recorded conflict"""
+        with self._lock:
+            self._conn.execute('DELETE FROM conflicts')
+
+
+class JournaledStorage(CodeStorage):
+    """Storage wrapper that confirms redemptions as soon as they are journaled
+
+    redeem_code() appends to the journal. A background thread writes pending
+    redemptions to the wrapped storage every FLUSH_INTERVAL seconds in one
+    batched request, and codes loaded from storage show pending redemptions
+    as already applied. Callers must check the code exists and is unredeemed
+    in the index first. Unless they pass verify_row=False because the index
+    is fresh, the code is instead redeemed straight in storage, which reads
+    the Redeemed cell first, so one redeemed by another process is refused.
+
+    Redemptions keep being accepted while storage is unreachable, journaled
+    straight away once is_degraded() says so or a flush has failed. Every
+    flush reads each code's status back first, and codes storage shows
+    redeemed at another time are recorded as conflicts instead of being
+    overwritten.
+    """
+
+    def __init__(self, storage, journal, is_fresh=None, is_degraded=None, flush_interval=FLUSH_INTERVAL):
+        self.storage = storage
+        self.journal = journal
+        # Whether row numbers from the last load can be trusted when flushing
+        self.is_fresh = is_fresh
+        # Whether storage is known to be unreachable, so redemptions shouldn't wait on it
+        self.is_degraded = is_degraded
+        self.flush_interval = flush_interval
+        self.flushed = 0
+        self.dropped = 0
+        self.last_flush_error = None
+        # Held while writing to storage so a direct status write can't be
+        # overtaken by an older journaled one
+        self._flush_lock = threading.Lock()
+        self._redeem_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='redemption-flusher', daemon=True)
+        self._thread.start()
+
+    def __getattr__(self, name):
+        # Anything else, such as the scheduler, comes from the wrapped storage
+        return getattr(self.storage, name)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                taken = self.flush()
+                flushed_any = taken > 0
+                while taken == FLUSH_BATCH_SIZE:
+                    taken = self.flush()
+                # An empty journal says nothing about whether storage is back
+                if flushed_any:
+                    self.last_flush_error = None
+            except Exception as e:
+                # Entries stay in the journal and are retried next time
+                self.last_flush_error = str(e)
+                logger.warning("Failed to flush redemption journal: %s", e)
+
+    def flush(self):
+        """Write the oldest pending redemptions to storage, returning how many were taken"""
+        with self._flush_lock:
+            entries = self.journal.oldest(FLUSH_BATCH_SIZE)
+            if not entries:
+                return 0
+
+            with metrics.timer('journal.flush'):
+                redemptions = {code: redeemed_at for _, code, redeemed_at in entries}
+                verify_rows = self.is_fresh is None or not self.is_fresh()
+
+                # Another process may have redeemed some of the codes since
+                # they were journaled - never overwrite its redemption
+                conflicts = []
+                statuses = self.storage.read_statuses(list(redemptions), verify_rows=verify_rows)
+                for code, redeemed_at in list(redemptions.items()):
+                    redeemed, stored_redeemed_at = statuses.get(code, (False, ''))
+                    if redeemed and stored_redeemed_at != redeemed_at:
+                        conflicts.append((code, redeemed_at, stored_redeemed_at))
+                        del redemptions[code]
+
+                found = self.storage.write_redemptions(redemptions, verify_rows=verify_rows) if redemptions else set()
+                if conflicts:
+                    self.journal.record_conflicts(conflicts)
+                # Codes no longer in storage were deleted meanwhile - nothing to write
+                self.journal.remove(
+                    [code for _, code, _ in entries], max(entry_id for entry_id, _, _ in entries)
+                )
+                self.flushed += len(found)
+                self.dropped += len(redemptions) - len(found)
+                return len(entries)
+
+    def close(self):
+        """Stop the background flusher after one last flush"""
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+    def apply_pending(self, codes):
+        """Show pending redemptions in codes loaded from storage"""
+        for code, redeemed_at in self.journal.pending_items():
+            if code in codes:
+                codes.set_status(code, True, redeemed_at)
+
+    def load_codes(self):
+        codes = self.storage.load_codes()
+        self.apply_pending(codes)
+        return codes
+
+    def sync_codes(self, codes):
+        if not self.storage.sync_codes(codes):
+            return False
+        self.apply_pending(codes)
+        return True
+
+    def sync_state(self):
+        return self.storage.sync_state()
+
+    def restore_sync_state(self, state):
+        self.storage.restore_sync_state(state)
+
+    def save_codes_batch(self, codes_list, deal=''):
+        return self.storage.save_codes_batch(codes_list, deal)
+
+    def update_code_status(self, code, redeemed, redeemed_at='', verify_row=True):
+        with self._flush_lock:
+            up_to_id = self.journal.last_id()
+            found = self.storage.update_code_status(code, redeemed, redeemed_at, verify_row)
+            # This write supersedes any redemption of the code still pending
+            if found:
+                self.journal.remove([code], up_to_id)
+        return found
+
+    def update_codes_status(self, codes_list, redeemed, redeemed_at='', verify_rows=True):
+        with self._flush_lock:
+            up_to_id = self.journal.last_id()
+            found = self.storage.update_codes_status(codes_list, redeemed, redeemed_at, verify_rows)
+            self.journal.remove(found, up_to_id)
+        return found
+
+    def read_statuses(self, codes_list, verify_rows=True):
+        return self.storage.read_statuses(codes_list, verify_rows)
+
+    def write_redemptions(self, redemptions, verify_rows=True):
+        return self.storage.write_redemptions(redemptions, verify_rows)
+
+    def redeem_code(self, code, redeemed_at, verify_row=True):
+        pending_at = self.journal.pending_for(code)
+        if pending_at is not None:
+            return ALREADY_REDEEMED, pending_at
+
+        # With a stale index another process may have redeemed the code
+        # meanwhile, so redeem it straight in storage, which checks the
+        # Redeemed cell first. While storage is known to be unreachable
+        # redemptions are journaled instead, and the flush that finally
+        # writes them records any that clash as conflicts.
+        degraded = self.last_flush_error is not None or (self.is_degraded is not None and self.is_degraded())
+        if verify_row and not degraded:
+            try:
+                # Held so no older journaled redemption of the code overtakes this one
+                with self._flush_lock:
+                    return self.storage.redeem_code(code, redeemed_at, verify_row=True)
+            except Exception as e:
+                self.last_flush_error = str(e)
+                logger.warning("Failed to redeem %s in storage, journaling it instead: %s", code, e)
+
+        with self._redeem_lock:
+            pending_at = self.journal.pending_for(code)
+            if pending_at is not None:
+                return ALREADY_REDEEMED, pending_at
+            self.journal.append(code, redeemed_at)
+        return REDEEMED, redeemed_at
+
+    def delete_all_codes(self):
+        with self._flush_lock:
+            self.storage.delete_all_codes()
+            self.journal.clear()
+
+    def delete_codes(self, codes_list, archive=False):
+        # Write pending redemptions first so the archive has them
+        while self.flush() == FLUSH_BATCH_SIZE:
+            pass
+        with self._flush_lock:
+            up_to_id = self.journal.last_id()
+            deleted = self.storage.delete_codes(codes_list, archive)
+            self.journal.remove(deleted, up_to_id)
+        return deleted
+
+    def reserve_code_indices(self, count):
+        return self.storage.reserve_code_indices(count)
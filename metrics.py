@@ -0,0 +1,194 @@
+import contextlib
+import contextvars
+import json
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+# Most recent latencies kept per operation for the percentiles
+SAMPLES_PER_OPERATION = 2048
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Prefix of every metric name in the Prometheus output
+METRIC_PREFIX = 'discount_portal'
+
+# Action Sheets requests are charged to when no user action is running,
+# e.g. background refreshes and journal flushes
+BACKGROUND_ACTION = 'background'
+
+# The user action running in this thread or task, e.g. 'redeem_code'
+_current_action = contextvars.ContextVar('current_action', default=None)
+
+
+def _quantile(sorted_samples, q):
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[min(len(sorted_samples) - 1, int(q * len(sorted_samples)))]
+
+
+class Metrics:
+    """Process-wide latency, Sheets traffic and cache counters
+
+    Operations record their latency into a window of recent samples, from
+    which p50/p95/p99 are worked out on demand. Sheets requests and the bytes
+    they send and receive are charged to the user action running at the
+    time. While disabled, instrumented code pays for one attribute check.
+    """
+
+    def __init__(self, enabled=False, samples=SAMPLES_PER_OPERATION):
+        self.enabled = enabled
+        self.samples = samples
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far"""
+        with self._lock:
+            self.latencies = {}
+            # operation -> [count, total seconds] over all time, not just the window
+            self.totals = {}
+            self.counters = {}
+            # action -> [requests, bytes sent, bytes received]
+            self.sheets = {}
+            self.started_at = time.time()
+
+    def observe(self, operation, seconds):
+        """Record one latency of an operation"""
+        with self._lock:
+            window = self.latencies.get(operation)
+            if window is None:
+                window = self.latencies[operation] = deque(maxlen=self.samples)
+                self.totals[operation] = [0, 0.0]
+            window.append(seconds)
+            totals = self.totals[operation]
+            totals[0] += 1
+            totals[1] += seconds
+
+    def count(self, name, amount=1):
+        """Add to a named counter"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_request(self, bytes_sent, bytes_received):
+        """Charge one Sheets HTTP request to the current user action"""
+        if not self.enabled:
+            return
+        action = _current_action.get() or BACKGROUND_ACTION
+        with self._lock:
+            usage = self.sheets.get(action)
+            if usage is None:
+                usage = self.sheets[action] = [0, 0, 0]
+            usage[0] += 1
+            usage[1] += bytes_sent
+            usage[2] += bytes_received
+
+    @contextlib.contextmanager
+    def _timed(self, operation):
+        # The outermost operation is the user action requests are charged to
+        token = _current_action.set(operation) if _current_action.get() is None else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(operation, time.perf_counter() - start)
+            if token is not None:
+                _current_action.reset(token)
+
+    def timer(self, operation):
+        """Context manager timing a block as operation"""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timed(operation)
+
+    def instrument(self, operation=None):
+        """Decorator timing every call of a function as operation (default: its name)"""
+        def decorator(func):
+            name = operation or func.__name__
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self._timed(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """Get everything recorded as plain dicts, with latencies summarized in seconds"""
+        with self._lock:
+            windows = {operation: sorted(window) for operation, window in self.latencies.items()}
+            totals = {operation: list(values) for operation, values in self.totals.items()}
+            counters = dict(self.counters)
+            sheets = {action: list(usage) for action, usage in self.sheets.items()}
+            started_at = self.started_at
+
+        operations = {}
+        for operation, samples in windows.items():
+            count, total = totals[operation]
+            summary = {'count': count, 'sum': total, 'max': samples[-1] if samples else 0.0}
+            for q in QUANTILES:
+                summary[f'p{int(q * 100)}'] = _quantile(samples, q)
+            operations[operation] = summary
+        return {
+            'enabled': self.enabled,
+            'since': started_at,
+            'operations': operations,
+            'sheets': {
+                action: {'requests': requests, 'bytes_sent': sent, 'bytes_received': received}
+                for action, (requests, sent, received) in sheets.items()
+            },
+            'counters': counters
+        }
+
+    def to_json(self):
+        """Dump a snapshot as JSON"""
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        """Dump a snapshot in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = [
+            f'# HELP {METRIC_PREFIX}_operation_seconds Latency of app operations over recent calls',
+            f'# TYPE {METRIC_PREFIX}_operation_seconds summary'
+        ]
+        for operation, summary in sorted(snapshot['operations'].items()):
+            for q in QUANTILES:
+                lines.append(
+                    f'{METRIC_PREFIX}_operation_seconds{{operation="{operation}",quantile="{q}"}} '
+                    f'{summary[f"p{int(q * 100)}"]:.6f}'
+                )
+            lines.append(f'{METRIC_PREFIX}_operation_seconds_sum{{operation="{operation}"}} {summary["sum"]:.6f}')
+            lines.append(f'{METRIC_PREFIX}_operation_seconds_count{{operation="{operation}"}} {summary["count"]}')
+
+        lines += [
+            f'# HELP {METRIC_PREFIX}_sheets_requests_total Google Sheets HTTP requests by user action',
+            f'# TYPE {METRIC_PREFIX}_sheets_requests_total counter'
+        ]
+        for action, usage in sorted(snapshot['sheets'].items()):
+            lines.append(f'{METRIC_PREFIX}_sheets_requests_total{{action="{action}"}} {usage["requests"]}')
+        lines += [
+            f'# HELP {METRIC_PREFIX}_sheets_bytes_total Google Sheets request and response bytes by user action',
+            f'# TYPE {METRIC_PREFIX}_sheets_bytes_total counter'
+        ]
+        for action, usage in sorted(snapshot['sheets'].items()):
+            lines.append(f'{METRIC_PREFIX}_sheets_bytes_total{{action="{action}",direction="sent"}} {usage["bytes_sent"]}')
+            lines.append(
+                f'{METRIC_PREFIX}_sheets_bytes_total{{action="{action}",direction="received"}} {usage["bytes_received"]}'
+            )
+
+        lines += [
+            f'# HELP {METRIC_PREFIX}_events_total Counted events such as code cache hits',
+            f'# TYPE {METRIC_PREFIX}_events_total counter'
+        ]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'{METRIC_PREFIX}_events_total{{event="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# Shared by every session and thread in the process
+metrics = Metrics()
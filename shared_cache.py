@@ -0,0 +1,137 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+# Seconds between checks for changes published by other processes
+POLL_INTERVAL = 1.0
+
+# Seconds changes are kept. A process that falls further behind than this
+# reloads its codes from storage instead.
+RETENTION = 3600
+
+# Seconds of changes a newly started process applies on top of what it loads,
+# covering redemptions other processes haven't flushed to the sheet yet
+REPLAY_WINDOW = 120
+
+# Publishes between deletions of expired changes
+PRUNE_EVERY = 1000
+
+# A poll that finds changes were pruned before this process saw them
+RELOAD = 'reload'
+
+
+class SharedChangeLog:
+    """Versioned feed of code table changes shared by the app processes on one host
+
+    Every add, status change and delete-all made by one process is appended
+    to a SQLite database in WAL mode. Other processes poll for entries newer
+    than the last version they applied and replay them on their own index,
+    so no process has to go back to storage to see another's writes. The
+    same database holds redemption claims, which stop two processes
+    redeeming one code at once.
+    """
+
+    def __init__(self, path, poll_interval=POLL_INTERVAL, retention=RETENTION, replay_window=REPLAY_WINDOW):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        # Tells this process's own entries apart from everyone else's
+        self.origin = uuid.uuid4().hex
+        self.polled_at = None
+        self.published = 0
+        self.applied = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            # Storage stays the source of truth, so a change lost in a power
+            # cut only delays other processes until their next sync
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS changes ('
+                'version INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, kind TEXT NOT NULL, '
+                'payload TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_changes_created_at ON changes (created_at)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS claims ('
+                'code TEXT PRIMARY KEY, redeemed_at TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+            # Start just before the recent changes, which the storage we are
+            # about to load from may not have caught up with
+            row = self._conn.execute(
+                'SELECT MIN(version) FROM changes WHERE created_at >= ?', (time.time() - replay_window,)
+            ).fetchone()
+            if row[0] is not None:
+                self.last_version = row[0] - 1
+            else:
+                self.last_version = self._conn.execute('SELECT COALESCE(MAX(version), 0) FROM changes').fetchone()[0]
+
+    def publish(self, kind, args):
+        """Append one of this process's changes to the feed"""
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.execute(
+                    'INSERT INTO changes (origin, kind, payload, created_at) VALUES (?, ?, ?, ?)',
+                    (self.origin, kind, json.dumps(args), now)
+                )
+                # The claims follow the status, so a reinvoked code can be redeemed again
+                if kind == 'status' and not args[1]:
+                    self._conn.execute('DELETE FROM claims WHERE code = ?', (args[0],))
+                elif kind == 'clear':
+                    self._conn.execute('DELETE FROM claims')
+                self.published += 1
+                if self.published % PRUNE_EVERY == 0:
+                    self._conn.execute('DELETE FROM changes WHERE created_at < ?', (now - self.retention,))
+                    self._conn.execute('DELETE FROM claims WHERE created_at < ?', (now - self.retention,))
+
+    def poll(self, force=False):
+        """Get (kind, args) for changes other processes made since the last poll
+
+        Returns [(RELOAD, None)] if changes this process never saw were
+        pruned, in which case codes must be reloaded from storage.
+        """
+        now = time.monotonic()
+        if not force and self.polled_at is not None and now - self.polled_at < self.poll_interval:
+            return []
+        self.polled_at = now
+
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT version, origin, kind, payload FROM changes WHERE version > ? ORDER BY version',
+                (self.last_version,)
+            ).fetchall()
+            if not rows:
+                return []
+            # Versions only have gaps where old changes were pruned
+            behind = rows[0][0] > self.last_version + 1
+            self.last_version = rows[-1][0]
+
+        if behind:
+            return [(RELOAD, None)]
+        changes = [(kind, json.loads(payload)) for _, origin, kind, payload in rows if origin != self.origin]
+        self.applied += len(changes)
+        return changes
+
+    def claim(self, code, redeemed_at):
+        """Claim the redemption of code, returning None or the Redeemed At of an earlier claim"""
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                row = self._conn.execute('SELECT redeemed_at FROM claims WHERE code = ?', (code,)).fetchone()
+                if row is not None:
+                    return row[0]
+                self._conn.execute(
+                    'INSERT INTO claims (code, redeemed_at, created_at) VALUES (?, ?, ?)',
+                    (code, redeemed_at, time.time())
+                )
+        return None
+
+    def release(self, code):
+        """Drop a claim whose redemption didn't go ahead"""
+        with self._lock:
+            self._conn.execute('DELETE FROM claims WHERE code = ?', (code,))
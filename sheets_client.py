@@ -0,0 +1,137 @@
+import threading
+import time
+
+import gspread
+from google.auth.transport.requests import AuthorizedSession
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+
+from metrics import metrics
+
+# Seconds between checks that the shared connection still works
+HEALTH_CHECK_INTERVAL = 300
+
+# Keep-alive HTTPS connections kept open to Google, enough for every session
+# on the server to have a request in flight at once
+HTTP_POOL_SIZE = 32
+
+# Seconds before a request to Google is abandoned
+REQUEST_TIMEOUT = 30
+
+# Columns of a newly created archive worksheet
+ARCHIVE_COLUMNS = 5
+
+
+class SheetsConnection:
+    """One gspread client and worksheet handle shared by every session in the process
+
+    Nothing is sent to Google until a worksheet is first asked for. The
+    underlying session reuses HTTPS connections and refreshes the access token
+    as it expires, and the connection is checked every HEALTH_CHECK_INTERVAL
+    seconds and reopened if the check fails.
+    """
+
+    def __init__(self, credentials_info, spreadsheet_url, scopes, counter_title=None, archive_title=None,
+                 health_check_interval=HEALTH_CHECK_INTERVAL):
+        self.credentials_info = credentials_info
+        self.spreadsheet_url = spreadsheet_url
+        self.scopes = scopes
+        # Title of the worksheet holding the code allocator's counter, if used
+        self.counter_title = counter_title
+        # Title of the worksheet retired codes are archived to, if used
+        self.archive_title = archive_title
+        self.health_check_interval = health_check_interval
+        self.spreadsheet = None
+        self.checked_at = None
+        self.connects = 0
+        self._worksheet = None
+        self._counter_worksheet = None
+        self._archive_worksheet = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """Authorize and open the spreadsheet, replacing any existing handles"""
+        creds = Credentials.from_service_account_info(self.credentials_info, scopes=self.scopes)
+        session = AuthorizedSession(creds)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount('https://', adapter)
+        session.hooks['response'].append(self._record_response)
+        client = gspread.authorize(creds, session=session)
+        client.set_timeout(REQUEST_TIMEOUT)
+
+        spreadsheet = client.open_by_url(self.spreadsheet_url)
+        counter_worksheet = None
+        if self.counter_title:
+            try:
+                counter_worksheet = spreadsheet.worksheet(self.counter_title)
+            except gspread.WorksheetNotFound:
+                counter_worksheet = spreadsheet.add_worksheet(self.counter_title, rows=1, cols=2)
+
+        self.spreadsheet = spreadsheet
+        self._worksheet = spreadsheet.sheet1
+        self._counter_worksheet = counter_worksheet
+        # Opened when first needed, as most sessions never archive anything
+        self._archive_worksheet = None
+        self.checked_at = time.monotonic()
+        self.connects += 1
+
+    @staticmethod
+    def _record_response(response, *args, **kwargs):
+        # Charge every request to the user action that caused it
+        if metrics.enabled:
+            body = response.request.body
+            metrics.record_request(len(body) if body else 0, len(response.content))
+
+    def is_healthy(self):
+        """Make the cheapest possible request to check the connection works"""
+        try:
+            self.spreadsheet.fetch_sheet_metadata(params={'fields': 'spreadsheetId'})
+            return True
+        except Exception:
+            return False
+
+    def ensure_connected(self):
+        """Connect on first use, and reconnect if a periodic health check fails"""
+        checked_at = self.checked_at
+        if checked_at is not None and time.monotonic() - checked_at < self.health_check_interval:
+            return
+
+        with self._lock:
+            # Another session may have connected or checked while we waited
+            if self.checked_at is not None and time.monotonic() - self.checked_at < self.health_check_interval:
+                return
+            if self.spreadsheet is not None and self.is_healthy():
+                self.checked_at = time.monotonic()
+                return
+            self.connect()
+
+    def reset(self):
+        """Drop the connection so the next request opens a fresh one"""
+        with self._lock:
+            self.checked_at = None
+            self.spreadsheet = None
+
+    def worksheet(self):
+        """Get the shared worksheet holding the codes"""
+        self.ensure_connected()
+        return self._worksheet
+
+    def counter_worksheet(self):
+        """Get the shared allocator counter worksheet, or None if not used"""
+        self.ensure_connected()
+        return self._counter_worksheet
+
+    def archive_worksheet(self):
+        """Get the archive worksheet, creating it on first use, or None if not used"""
+        if not self.archive_title:
+            return None
+        self.ensure_connected()
+        with self._lock:
+            if self._archive_worksheet is None:
+                try:
+                    self._archive_worksheet = self.spreadsheet.worksheet(self.archive_title)
+                except gspread.WorksheetNotFound:
+                    self._archive_worksheet = self.spreadsheet.add_worksheet(
+                        self.archive_title, rows=1, cols=ARCHIVE_COLUMNS
+                    )
+            return self._archive_worksheet
@@ -0,0 +1,319 @@
+import random
+import threading
+import time
+
+import requests
+from google.auth.exceptions import RefreshError
+
+# Google Sheets allows 60 read and 60 write requests per minute per user,
+# which is what the service account counts as
+READ_REQUESTS_PER_MINUTE = 60
+WRITE_REQUESTS_PER_MINUTE = 60
+
+# Retries of a throttled or failed request, waiting about 1, 2, 4... seconds
+# (plus jitter) between attempts, capped at MAX_BACKOFF
+MAX_RETRIES = 6
+BASE_BACKOFF = 1.0
+MAX_BACKOFF = 32.0
+
+# HTTP statuses worth retrying: quota exceeded and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Quota exceeded - the one answer that guarantees a request was not applied
+QUOTA_STATUS = 429
+
+
+class QuotaExceededError(Exception):
+    """Google Sheets kept refusing a request after every retry"""
+
+
+def is_retryable(error, idempotent=True):
+    """Check whether a failed request is worth retrying
+
+    A request that timed out or failed with a 5xx may still have been
+    applied, so unless sending it twice is harmless it is only retried
+    after a 429.
+    """
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if not idempotent:
+        return status == QUOTA_STATUS
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return status in RETRY_STATUSES
+
+
+def is_auth_error(error):
+    """Check whether a request failed because Google rejected the connection's credentials"""
+    if isinstance(error, RefreshError):
+        return True
+    return getattr(getattr(error, 'response', None), 'status_code', None) == 401
+
+
+class TokenBucket:
+    """Hands out up to rate_per_minute tokens a minute, allowing bursts of capacity"""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Take a token, returning 0 on success or the seconds until one is free"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class _InFlightRead:
+    def __init__(self, generation):
+        self.generation = generation
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _WriteBatch:
+    def __init__(self):
+        self.data = []
+        self.done = threading.Event()
+        self.error = None
+
+
+class SheetsScheduler:
+    """Central gate for Sheets API calls - rate limits, retries and coalesces them
+
+    Every call first takes a token from the read or write bucket, waiting if
+    the per-minute quota is used up, and is retried with exponential backoff
+    and jitter when Google answers 429 or a 5xx. Identical reads running at
+    the same time share one request, and range writes queued while waiting
+    for a write token go out together as one batch_update. When credentials
+    are rejected, on_auth_error() is called, e.g. to reopen the connection.
+    """
+
+    def __init__(self, reads_per_minute=READ_REQUESTS_PER_MINUTE, writes_per_minute=WRITE_REQUESTS_PER_MINUTE,
+                 max_retries=MAX_RETRIES, sleep=time.sleep, on_auth_error=None):
+        self.buckets = {
+            'read': TokenBucket(reads_per_minute),
+            'write': TokenBucket(writes_per_minute)
+        }
+        self.max_retries = max_retries
+        self.sleep = sleep
+        self.on_auth_error = on_auth_error
+        # Bumped after every write so reads never join a fetch that may
+        # have started before the write landed
+        self.write_generation = 0
+        self._in_flight = {}
+        self._pending_writes = {}
+        self._lock = threading.Lock()
+        self.counters = {
+            'reads': 0,
+            'writes': 0,
+            'throttled': 0,
+            'retries': 0,
+            'failures': 0,
+            'coalesced_reads': 0,
+            'merged_writes': 0
+        }
+        self.waiting = 0
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def acquire(self, kind):
+        """Wait for a token from the read or write bucket"""
+        bucket = self.buckets[kind]
+        wait = bucket.try_acquire()
+        if not wait:
+            return
+        self._count('throttled')
+        with self._lock:
+            self.waiting += 1
+        try:
+            while wait:
+                self.sleep(wait)
+                wait = bucket.try_acquire()
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def call(self, kind, request, acquired=False, idempotent=True):
+        """Run request() under the kind's quota, retrying throttled attempts
+
+        Pass idempotent=False for requests that do harm if applied twice,
+        such as deleting rows by number.
+        """
+        for attempt in range(self.max_retries + 1):
+            if not acquired:
+                self.acquire(kind)
+            acquired = False
+            self._count(kind + 's')
+            try:
+                result = request()
+            except Exception as e:
+                if kind == 'write':
+                    # A failed write may still have landed
+                    self._bump_generation()
+                if not is_retryable(e, idempotent):
+                    if self.on_auth_error is not None and is_auth_error(e):
+                        self.on_auth_error()
+                    raise
+                if attempt == self.max_retries:
+                    self._count('failures')
+                    raise QuotaExceededError(
+                        "Google Sheets is busy right now, please try again in a minute"
+                    ) from e
+                self._count('retries')
+                backoff = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt)
+                self.sleep(backoff + random.uniform(0, backoff))
+            else:
+                if kind == 'write':
+                    self._bump_generation()
+                return result
+
+    def _bump_generation(self):
+        with self._lock:
+            self.write_generation += 1
+
+    def read(self, key, request):
+        """Run a read, sharing the result with identical reads already in flight
+
+        Shared results are handed to every caller, so they must not be modified.
+        """
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            leader = in_flight is None or in_flight.generation != self.write_generation
+            if leader:
+                in_flight = self._in_flight[key] = _InFlightRead(self.write_generation)
+            else:
+                self.counters['coalesced_reads'] += 1
+
+        if not leader:
+            in_flight.done.wait()
+        else:
+            try:
+                in_flight.result = self.call('read', request)
+            except Exception as e:
+                in_flight.error = e
+            finally:
+                with self._lock:
+                    if self._in_flight.get(key) is in_flight:
+                        del self._in_flight[key]
+                in_flight.done.set()
+
+        if in_flight.error is not None:
+            raise in_flight.error
+        return in_flight.result
+
+    def write(self, request, idempotent=True):
+        """Run a write"""
+        return self.call('write', request, idempotent=idempotent)
+
+    def update(self, worksheet, range_name, values, value_input_option='RAW'):
+        """Write one range, merged with other range writes queued for the same worksheet"""
+        key = (id(worksheet), value_input_option)
+        with self._lock:
+            batch = self._pending_writes.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._pending_writes[key] = _WriteBatch()
+            else:
+                self.counters['merged_writes'] += 1
+            batch.data.append({'range': range_name, 'values': values})
+
+        if not leader:
+            batch.done.wait()
+        else:
+            try:
+                # Writes arriving while we wait for a token join this batch
+                self.acquire('write')
+                with self._lock:
+                    del self._pending_writes[key]
+                self.call('write', lambda: worksheet.batch_update(batch.data, value_input_option=value_input_option),
+                          acquired=True)
+            except Exception as e:
+                batch.error = e
+            finally:
+                with self._lock:
+                    if self._pending_writes.get(key) is batch:
+                        del self._pending_writes[key]
+                batch.done.set()
+
+        if batch.error is not None:
+            raise batch.error
+
+    def stats(self):
+        """Get the request counters plus how many calls are waiting right now"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats['queue_depth'] = self.waiting + sum(len(batch.data) - 1 for batch in self._pending_writes.values())
+        return stats
+
+
+class ScheduledWorksheet:
+    """Worksheet wrapper that sends every API call through a SheetsScheduler"""
+
+    def __init__(self, worksheet, scheduler):
+        self.worksheet = worksheet
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        # Plain attributes such as row_count, title and spreadsheet
+        return getattr(self.worksheet, name)
+
+    def _read(self, method, *args):
+        key = (id(self.worksheet), method) + args
+        return self.scheduler.read(key, lambda: getattr(self.worksheet, method)(*args))
+
+    def get_all_values(self):
+        return self._read('get_all_values')
+
+    def row_values(self, row):
+        return self._read('row_values', row)
+
+    def col_values(self, col):
+        return self._read('col_values', col)
+
+    def get(self, range_name):
+        return self._read('get', range_name)
+
+    def batch_get(self, ranges):
+        return self.scheduler.read(
+            (id(self.worksheet), 'batch_get') + tuple(ranges),
+            lambda: self.worksheet.batch_get(ranges)
+        )
+
+    def acell(self, label):
+        return self._read('acell', label)
+
+    def update(self, values=None, range_name=None, value_input_option='RAW'):
+        self.scheduler.update(self.worksheet, range_name, values, value_input_option)
+
+    def batch_update(self, data, value_input_option='RAW'):
+        return self.scheduler.write(lambda: self.worksheet.batch_update(data, value_input_option=value_input_option))
+
+    def append_rows(self, values, value_input_option='RAW', insert_data_option=None, table_range=None):
+        # Appending twice would save the rows twice
+        return self.scheduler.write(
+            lambda: self.worksheet.append_rows(
+                values, value_input_option=value_input_option, insert_data_option=insert_data_option,
+                table_range=table_range
+            ),
+            idempotent=False
+        )
+
+    def add_rows(self, rows):
+        return self.scheduler.write(lambda: self.worksheet.add_rows(rows), idempotent=False)
+
+    def delete_rows(self, start_index, end_index=None):
+        return self.scheduler.write(lambda: self.worksheet.delete_rows(start_index, end_index), idempotent=False)
+
+    def resize(self, rows=None, cols=None):
+        return self.scheduler.write(lambda: self.worksheet.resize(rows, cols))
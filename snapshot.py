@@ -0,0 +1,179 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+from code_store import CompactCodeStore
+
+MAGIC = b'DPCODES\x00'
+FORMAT_VERSION = 1
+
+# Seconds between snapshot writes while the code table keeps changing
+SNAPSHOT_INTERVAL = 60
+
+# Magic, format version, index version, code count, deal count, then the
+# byte offset and length of each section
+SECTIONS = ('codes', 'deals', 'deal_column', 'redeemed_bits', 'redeemed_at_column', 'rows', 'meta')
+HEADER = struct.Struct('<8sIQQI' + 'QQ' * len(SECTIONS))
+
+# Sections start on 8-byte boundaries so the columns can be used in place
+ALIGNMENT = 8
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotError(Exception):
+    """A snapshot file is missing, corrupt or in an unknown format"""
+
+
+def _little_endian(column):
+    if sys.byteorder != 'little':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column
+
+
+class CodeSnapshot:
+    """Local binary copy of the code table for fast start-up
+
+    The file is a fixed header followed by column sections laid out like the
+    CompactCodeStore columns: codes and deals as NUL-separated UTF-8, then
+    little-endian arrays of deal IDs, sheet rows and Redeemed At seconds and
+    the redeemed bitset, with everything else in a small JSON section. It is
+    memory-mapped when read and replaced atomically when written.
+    """
+
+    def __init__(self, path, interval=SNAPSHOT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.saved_version = None
+        self.saved_at = None
+        self._saving = threading.Lock()
+
+    def save(self, codes, version=0, sync_state=None):
+        """Write codes and the storage sync state, replacing any previous snapshot
+
+        sync_state must not be newer than codes - see CodeIndex.snapshot_view().
+        """
+        # Columns are filled before a code is published, so taking the codes
+        # first gives a consistent prefix of every column
+        code_list = list(codes.codes)
+        count = len(code_list)
+        deals = list(codes.deals)
+        sync_state = dict(sync_state or {})
+        rows = sync_state.pop('rows', None) or {}
+
+        sections = {
+            'codes': '\x00'.join(code_list).encode(),
+            'deals': '\x00'.join(deals).encode(),
+            'deal_column': _little_endian(codes.deal_column[:count]).tobytes(),
+            'redeemed_bits': bytes(codes.redeemed_bits[:(count + 7) // 8]),
+            'redeemed_at_column': _little_endian(codes.redeemed_at_column[:count]).tobytes(),
+            'rows': _little_endian(array('I', (rows.get(code, 0) for code in code_list))).tobytes(),
+            'meta': json.dumps({
+                'raw_redeemed_at': {str(slot): value for slot, value in codes.raw_redeemed_at.items() if slot < count},
+                'sync_state': sync_state,
+                'saved_at': time.time()
+            }).encode()
+        }
+
+        offsets = []
+        layout = []
+        position = HEADER.size
+        for name in SECTIONS:
+            position += -position % ALIGNMENT
+            offsets.append(position)
+            layout += [position, len(sections[name])]
+            position += len(sections[name])
+
+        # A temporary file of our own next to the snapshot, so processes
+        # saving at the same time never write into each other's file
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)), prefix=os.path.basename(self.path), suffix='.tmp'
+        )
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, FORMAT_VERSION, version, count, len(deals), *layout))
+                for name, offset in zip(SECTIONS, offsets):
+                    f.write(b'\x00' * (offset - f.tell()))
+                    f.write(sections[name])
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+        self.saved_version = version
+        self.saved_at = time.monotonic()
+
+    def load(self):
+        """Read the snapshot, returning (codes, sync_state)"""
+        try:
+            with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return self._parse(mapped)
+        except (OSError, ValueError, struct.error) as e:
+            raise SnapshotError(f"Can't read snapshot {self.path}: {e}") from e
+
+    def _parse(self, mapped):
+        magic, format_version, version, count, deal_count, *layout = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise SnapshotError(f"{self.path} is not a version {FORMAT_VERSION} code snapshot")
+        if layout[-2] + layout[-1] != len(mapped):
+            raise SnapshotError(f"{self.path} is truncated")
+        sections = {
+            name: mapped[offset:offset + length]
+            for name, offset, length in zip(SECTIONS, layout[0::2], layout[1::2])
+        }
+
+        code_list = sections['codes'].decode().split('\x00') if count else []
+        deals = sections['deals'].decode().split('\x00')
+        columns = {}
+        for name, typecode in (('deal_column', 'I'), ('redeemed_at_column', 'q'), ('rows', 'I')):
+            column = array(typecode)
+            column.frombytes(sections[name])
+            columns[name] = _little_endian(column)
+        if len(code_list) != count or len(deals) != deal_count or any(len(c) != count for c in columns.values()):
+            raise SnapshotError(f"{self.path} has inconsistent sections")
+
+        meta = json.loads(sections['meta'])
+        codes = CompactCodeStore.from_columns(
+            code_list,
+            deals,
+            columns['deal_column'],
+            bytearray(sections['redeemed_bits']),
+            columns['redeemed_at_column'],
+            {int(slot): value for slot, value in meta['raw_redeemed_at'].items()}
+        )
+        sync_state = dict(meta['sync_state'])
+        sync_state['rows'] = {code: row for code, row in zip(code_list, columns['rows']) if row}
+        return codes, sync_state
+
+    def save_if_due(self, index, storage):
+        """Save the index in a background thread if it changed and the interval has passed"""
+        if index.version == self.saved_version or not index.loaded:
+            return
+        if self.saved_at is not None and time.monotonic() - self.saved_at < self.interval:
+            return
+        if not self._saving.acquire(blocking=False):
+            return
+        # Claim this slot straight away so other sessions don't queue up saves
+        self.saved_at = time.monotonic()
+
+        def run():
+            try:
+                self.save(*index.snapshot_view(storage.sync_state))
+            except Exception as e:
+                logger.warning("Failed to save code snapshot: %s", e)
+            finally:
+                self._saving.release()
+
+        threading.Thread(target=run, name='code-snapshot', daemon=True).start()
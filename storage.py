@@ -0,0 +1,927 @@
+import re
+import sqlite3
+import threading
+import uuid
+from bisect import bisect_left
+from datetime import datetime
+
+from code_index import REDEEMED, ALREADY_REDEEMED, UNKNOWN_CODE
+from code_store import CompactCodeStore
+from metrics import metrics
+from sheets_scheduler import ScheduledWorksheet
+
+HEADERS = ['Code', 'Deal', 'Redeemed', 'Redeemed At']
+
+# Columns of the worksheet retired codes are archived to
+ARCHIVE_HEADERS = HEADERS + ['Archived At']
+
+# Label of each block of code indices appended to the allocator worksheet.
+# Older sheets hold a single counter in B1, which counts as the first block.
+RESERVED_LABEL = 'Reserved'
+
+# Rows whose status is read back in one batch_get by read_statuses
+STATUS_RANGES_PER_READ = 200
+
+
+def parse_codes(all_values, codes=None, first_row=2):
+    """Parse sheet values into a code store and a dict of code -> row number
+
+    all_values starts with the header row. To parse just some rows into an
+    existing store, pass the store and the sheet row of the first data row.
+    """
+    if codes is None:
+        codes = CompactCodeStore()
+    rows = {}
+    if len(all_values) < 2:
+        return codes, rows
+
+    # Get headers from first row and clean them
+    headers = [str(h).strip() for h in all_values[0]]
+
+    # Find column indices - search for headers case-insensitively
+    code_idx = None
+    deal_idx = None
+    redeemed_idx = None
+    redeemed_at_idx = None
+
+    for i, header in enumerate(headers):
+        header_lower = header.lower()
+        if header_lower == 'code':
+            code_idx = i
+        elif header_lower == 'deal':
+            deal_idx = i
+        elif header_lower == 'redeemed':
+            redeemed_idx = i
+        elif 'redeem' in header_lower and 'at' in header_lower:
+            redeemed_at_idx = i
+
+    # Fallback to positional if headers not found
+    if code_idx is None:
+        code_idx = 0
+    if deal_idx is None:
+        deal_idx = 1
+    if redeemed_idx is None:
+        redeemed_idx = 2
+    if redeemed_at_idx is None:
+        redeemed_at_idx = 3
+
+    # Process data rows (skip header) - sheet rows are 1-indexed
+    for row_num, row in enumerate(all_values[1:], start=first_row):
+        # Skip empty rows
+        if not row or not any(row):
+            continue
+
+        if len(row) > code_idx and row[code_idx]:
+            code = str(row[code_idx]).strip()
+            deal = str(row[deal_idx]).strip() if len(row) > deal_idx and row[deal_idx] else ''
+            redeemed_value = row[redeemed_idx] if len(row) > redeemed_idx else False
+            redeemed_at = str(row[redeemed_at_idx]).strip() if len(row) > redeemed_at_idx and row[redeemed_at_idx] else ''
+
+            # Handle different types for Redeemed field
+            if isinstance(redeemed_value, str):
+                redeemed_str = redeemed_value.strip().upper()
+                redeemed = redeemed_str == 'TRUE'
+            elif isinstance(redeemed_value, bool):
+                redeemed = redeemed_value
+            else:
+                redeemed = False
+
+            codes.add(code, deal, redeemed, redeemed_at)
+            rows[code] = row_num
+    return codes, rows
+
+
+def appended_row(response):
+    """Get the first row an append wrote to, from the updatedRange of the Sheets API response"""
+    match = re.search(r'![A-Z]+(\d+)', response['updates']['updatedRange'])
+    return int(match.group(1))
+
+
+def contiguous_row_ranges(rows):
+    """Group row numbers into sorted (first, last) runs of consecutive rows"""
+    ranges = []
+    for row in sorted(rows):
+        if ranges and ranges[-1][1] == row - 1:
+            ranges[-1][1] = row
+        else:
+            ranges.append([row, row])
+    return [tuple(row_range) for row_range in ranges]
+
+
+class CodeStorage:
+    """Interface every code storage backend implements
+
+    NotImplementedError only marks methods a backend has to override. A
+    backend missing something it needs, such as a worksheet, raises
+    RuntimeError instead.
+    """
+
+    def load_codes(self):
+        """Load all codes into a CompactCodeStore"""
+        raise NotImplementedError
+
+    def sync_codes(self, codes):
+        """Apply changes made since the last load to codes, returning False if a full reload is needed"""
+        return False
+
+    def sync_state(self):
+        """Get what sync_codes() needs to carry on from the last load, for saving in a snapshot"""
+        return None
+
+    def restore_sync_state(self, state):
+        """Carry on syncing from a state saved in a snapshot"""
+
+    def save_codes_batch(self, codes_list, deal=''):
+        """Add multiple unredeemed codes"""
+        raise NotImplementedError
+
+    def update_code_status(self, code, redeemed, redeemed_at='', verify_row=True):
+        """Set a code's redemption status, returning False if the code does not exist"""
+        raise NotImplementedError
+
+    def update_codes_status(self, codes_list, redeemed, redeemed_at='', verify_rows=True):
+        """Set the redemption status of many codes at once, returning the set of codes found"""
+        raise NotImplementedError
+
+    def read_statuses(self, codes_list, verify_rows=True):
+        """Read the current code -> (redeemed, redeemed_at) of codes, leaving out codes not found"""
+        raise NotImplementedError
+
+    def write_redemptions(self, redemptions, verify_rows=True):
+        """Mark codes redeemed at their own times from a dict of code -> redeemed_at, returning the set of codes found"""
+        raise NotImplementedError
+
+    def redeem_code(self, code, redeemed_at, verify_row=True):
+        """Redeem a code only if it is unredeemed, returning (outcome, redeemed_at)"""
+        raise NotImplementedError
+
+    def delete_all_codes(self):
+        """Delete every code"""
+        raise NotImplementedError
+
+    def delete_codes(self, codes_list, archive=False):
+        """Delete codes, copying them to the archive first if asked, returning the set of codes deleted"""
+        raise NotImplementedError
+
+    def reserve_code_indices(self, count):
+        """Advance the persisted allocation counter by count, returning its old value"""
+        raise NotImplementedError
+
+
+class SheetsStorage(CodeStorage):
+    """Codes stored in a gspread worksheet, or anything with the same API"""
+
+    def __init__(self, worksheet=None, counter_worksheet=None, connection=None, scheduler=None,
+                 archive_worksheet=None):
+        # Either fixed worksheets, or a shared SheetsConnection that opens
+        # them on first use
+        self.connection = connection
+        # Optional SheetsScheduler every API call is sent through
+        self.scheduler = scheduler
+        self._worksheet = worksheet
+        # Separate worksheet holding the code allocator's counter in B1
+        self._counter_worksheet = counter_worksheet
+        # Worksheet retired codes are copied to before they are deleted
+        self._archive_worksheet = archive_worksheet
+        self._headers_checked = False
+        self._headers_lock = threading.Lock()
+        # code -> sheet row number, filled by load_codes and kept current on writes
+        self.rows = {}
+        # What the last load or sync saw, for incremental syncs
+        self.last_row = None
+        self.last_code = ''
+        self.synced_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def worksheet(self):
+        worksheet = self.connection.worksheet() if self.connection is not None else self._worksheet
+        if self.scheduler is not None:
+            worksheet = ScheduledWorksheet(worksheet, self.scheduler)
+        if not self._headers_checked:
+            with self._headers_lock:
+                if not self._headers_checked:
+                    # Initialize headers if empty - don't modify existing sheets
+                    headers = worksheet.row_values(1)
+                    if not headers or not any(headers):
+                        worksheet.update(values=[HEADERS], range_name='A1:D1')
+                    self._headers_checked = True
+        return worksheet
+
+    @property
+    def counter_worksheet(self):
+        if self.connection is not None:
+            worksheet = self.connection.counter_worksheet()
+        else:
+            worksheet = self._counter_worksheet
+        if worksheet is not None and self.scheduler is not None:
+            worksheet = ScheduledWorksheet(worksheet, self.scheduler)
+        return worksheet
+
+    @property
+    def archive_worksheet(self):
+        if self.connection is not None:
+            worksheet = self.connection.archive_worksheet()
+        else:
+            worksheet = self._archive_worksheet
+        if worksheet is not None and self.scheduler is not None:
+            worksheet = ScheduledWorksheet(worksheet, self.scheduler)
+        return worksheet
+
+    def updated_at(self):
+        """Get the spreadsheet's last modified time from Drive, or None if unavailable"""
+        try:
+            spreadsheet = self.worksheet.spreadsheet
+            if self.scheduler is not None:
+                # Rate limited and retried like every other read
+                return self.scheduler.read((id(spreadsheet), 'get_lastUpdateTime'), spreadsheet.get_lastUpdateTime)
+            return spreadsheet.get_lastUpdateTime()
+        except Exception:
+            return None
+
+    def sync_state(self):
+        with self._lock:
+            return {'rows': dict(self.rows), 'synced_at': self.synced_at}
+
+    def restore_sync_state(self, state):
+        # Sync from the last code the snapshot holds. Rows added after it are
+        # read again, which is harmless, and a mismatch forces a full reload.
+        rows = (state or {}).get('rows') or {}
+        with self._lock:
+            self.rows = dict(rows)
+            self.synced_at = (state or {}).get('synced_at')
+            if rows:
+                self.last_code, self.last_row = max(rows.items(), key=lambda item: item[1])
+            else:
+                self.last_row = None
+                self.last_code = ''
+
+    def load_codes(self):
+        # Read the modified time first so edits made during the load are
+        # picked up by the next sync rather than missed
+        updated_at = self.updated_at()
+        with metrics.timer('sheets.get_all_values'):
+            all_values = self.worksheet.get_all_values()
+        with metrics.timer('parse_codes'):
+            codes, rows = parse_codes(all_values)
+        with self._lock:
+            self.rows = rows
+            self.synced_at = updated_at
+            # Delta syncs rely on the standard column layout
+            if len(all_values) > 0 and [str(h).strip() for h in all_values[0]][:4] == HEADERS:
+                self.last_row = len(all_values)
+                self.last_code = str(all_values[-1][0]).strip() if all_values[-1] else ''
+            else:
+                self.last_row = None
+        return codes
+
+    def sync_codes(self, codes):
+        with metrics.timer('sheets.sync_codes'):
+            return self._sync_codes(codes)
+
+    def _sync_codes(self, codes):
+        last_row = self.last_row
+        if last_row is None:
+            return False
+
+        # Nothing to read at all if the spreadsheet hasn't changed
+        updated_at = self.updated_at()
+        if updated_at is not None and updated_at == self.synced_at:
+            return True
+
+        # One request: the header, everything from the last row we know of
+        # onwards, and only the Redeemed/Redeemed At columns of the rest
+        ranges = ['A1:D1', f'A{last_row}:D']
+        if last_row >= 2:
+            ranges.append(f'C2:D{last_row}')
+        results = self.worksheet.batch_get(ranges)
+
+        header = results[0][0] if results[0] else []
+        if [str(h).strip() for h in header][:4] != HEADERS:
+            return False
+
+        # If our last known row no longer holds the same code, rows were
+        # deleted or moved (e.g. by delete_all_codes) and row numbers are stale
+        tail = results[1]
+        tail_code = str(tail[0][0]).strip() if tail and tail[0] else ''
+        if tail_code != self.last_code:
+            return False
+
+        # Refresh statuses of known rows, touching only codes that changed
+        if last_row >= 2:
+            statuses = results[2]
+            for code, row in list(self.rows.items()):
+                if row > last_row or code not in codes:
+                    continue
+                values = statuses[row - 2] if row - 2 < len(statuses) else []
+                redeemed = bool(values) and str(values[0]).strip().upper() == 'TRUE'
+                redeemed_at = str(values[1]).strip() if len(values) > 1 else ''
+                slot = codes.slots[code]
+                if codes.is_redeemed(slot) != redeemed or codes.redeemed_at_of(slot) != redeemed_at:
+                    codes.set_status(code, redeemed, redeemed_at)
+
+        # Append rows added after the last one we knew of
+        new_values = tail[1:]
+        if new_values:
+            _, new_rows = parse_codes([HEADERS] + new_values, codes, first_row=last_row + 1)
+            with self._lock:
+                self.rows.update(new_rows)
+                self.last_row = last_row + len(new_values)
+                self.last_code = str(new_values[-1][0]).strip() if new_values[-1] else ''
+
+        self.synced_at = updated_at
+        return True
+
+    def save_codes_batch(self, codes_list, deal=''):
+        # Prepare rows for batch insert - use 'FALSE' in uppercase for consistency
+        rows = [[str(code), str(deal), 'FALSE', ''] for code in codes_list]
+
+        # Sheets appends after the last row of the table itself, growing the
+        # grid as needed, so batches saved at the same time by other sessions
+        # or processes land one after the other instead of on the same rows.
+        # The table ends at the first blank row, so rows are inserted rather
+        # than written over whatever codes follow such a gap.
+        response = self.worksheet.append_rows(
+            rows, value_input_option='USER_ENTERED', insert_data_option='INSERT_ROWS', table_range='A1'
+        )
+        next_row = appended_row(response)
+        end_row = next_row + len(rows) - 1
+
+        with self._lock:
+            if self.last_row is not None and next_row <= self.last_row:
+                # Inserted at a blank row above rows we know of, pushing them down
+                self.rows = {
+                    code: row + len(rows) if row >= next_row else row for code, row in self.rows.items()
+                }
+                self.last_row += len(rows)
+            for offset, code in enumerate(codes_list):
+                self.rows[str(code)] = next_row + offset
+            # Only move the sync position past our rows if nothing was
+            # appended before them, so the next sync still reads any rows
+            # another process added in between
+            if self.last_row is not None and next_row == self.last_row + 1:
+                self.last_row = end_row
+                self.last_code = str(codes_list[-1])
+
+    def refresh_rows(self):
+        """Rebuild the row index by scanning column A"""
+        rows = {}
+        for row_idx, value in enumerate(self.worksheet.col_values(1)):
+            value = str(value).strip()
+            # Keep the last occurrence, matching load_codes; skip the header
+            if value and row_idx > 0:
+                rows[value] = row_idx + 1  # Sheets are 1-indexed
+        with self._lock:
+            self.rows = rows
+        return rows
+
+    def find_code_row(self, code):
+        """Find the row holding a code by scanning column A, rebuilding the row index"""
+        return self.refresh_rows().get(code)
+
+    def resolve_code_row(self, code, verify_row=True):
+        """Get the row for a code from the row index, checking the cell when it may be stale"""
+        target_row = self.rows.get(code)
+
+        # Rows may have shifted since the index was built - check the single
+        # cell before writing. Callers skip this when the index is known fresh.
+        if target_row is not None and verify_row:
+            if str(self.worksheet.acell(f'A{target_row}').value or '').strip() != code:
+                target_row = None
+
+        if target_row is None:
+            target_row = self.find_code_row(code)
+
+        return target_row
+
+    def update_code_status(self, code, redeemed, redeemed_at='', verify_row=True):
+        target_row = self.resolve_code_row(code, verify_row)
+        if target_row is None:
+            return False
+
+        # Columns C and D hold the redeemed status and its timestamp - write
+        # both in a single ranged request
+        self.worksheet.update(
+            values=[['TRUE' if redeemed else 'FALSE', redeemed_at]],
+            range_name=f'C{target_row}:D{target_row}',
+            value_input_option='USER_ENTERED'
+        )
+        return True
+
+    def resolve_code_rows(self, codes_list, verify_rows=True):
+        """Get code -> row for many codes, dropping codes that aren't in the sheet"""
+        # One read of column A checks every row at once when the index may be
+        # stale, rather than one cell read per code
+        rows = self.refresh_rows() if verify_rows else self.rows
+        if not verify_rows and any(code not in rows for code in codes_list):
+            rows = self.refresh_rows()
+        return {code: rows[code] for code in codes_list if code in rows}
+
+    def read_statuses(self, codes_list, verify_rows=True):
+        rows = self.resolve_code_rows(codes_list, verify_rows)
+        items = list(rows.items())
+        statuses = {}
+        # Many small ranges per request, but not so many the URL gets too long
+        for start in range(0, len(items), STATUS_RANGES_PER_READ):
+            chunk = items[start:start + STATUS_RANGES_PER_READ]
+            results = self.worksheet.batch_get([f'C{row}:D{row}' for _, row in chunk])
+            for (code, _), values in zip(chunk, results):
+                cells = list(values[0]) if values else []
+                cells += [''] * (2 - len(cells))
+                statuses[code] = (str(cells[0]).strip().upper() == 'TRUE', str(cells[1]).strip())
+        return statuses
+
+    def write_statuses(self, statuses, verify_rows=True):
+        """Write code -> (redeemed, redeemed_at) in one batched request, returning the set of codes found"""
+        rows = self.resolve_code_rows(list(statuses), verify_rows)
+        if rows:
+            self.worksheet.batch_update(
+                [
+                    {
+                        'range': f'C{row}:D{row}',
+                        'values': [['TRUE' if statuses[code][0] else 'FALSE', statuses[code][1]]]
+                    }
+                    for code, row in rows.items()
+                ],
+                value_input_option='USER_ENTERED'
+            )
+        return set(rows)
+
+    def update_codes_status(self, codes_list, redeemed, redeemed_at='', verify_rows=True):
+        return self.write_statuses({code: (redeemed, redeemed_at) for code in codes_list}, verify_rows)
+
+    def write_redemptions(self, redemptions, verify_rows=True):
+        return self.write_statuses(
+            {code: (True, redeemed_at) for code, redeemed_at in redemptions.items()}, verify_rows
+        )
+
+    def redeem_code(self, code, redeemed_at, verify_row=True):
+        target_row = self.resolve_code_row(code, verify_row)
+        if target_row is None:
+            return UNKNOWN_CODE, ''
+
+        # Re-read the Redeemed cell right before writing so a redemption made
+        # by another process since our index was loaded is not overwritten.
+        # Sheets has no conditional write, so this narrows the race across
+        # processes rather than closing it.
+        current = self.worksheet.get(f'C{target_row}:D{target_row}')
+        current = current[0] if current else []
+        if current and str(current[0]).strip().upper() == 'TRUE':
+            return ALREADY_REDEEMED, str(current[1]).strip() if len(current) > 1 else ''
+
+        self.worksheet.update(
+            values=[['TRUE', redeemed_at]],
+            range_name=f'C{target_row}:D{target_row}',
+            value_input_option='USER_ENTERED'
+        )
+        return REDEEMED, redeemed_at
+
+    def delete_all_codes(self):
+        # Delete all rows except the header - column A is enough to find the last one
+        num_rows = len(self.worksheet.col_values(1))
+        if num_rows > 1:
+            self.worksheet.delete_rows(2, num_rows)
+        with self._lock:
+            self.rows = {}
+            if self.last_row is not None:
+                self.last_row = 1
+                self.last_code = HEADERS[0]
+
+    def delete_codes(self, codes_list, archive=False):
+        # Always check row numbers against the sheet - deleting a row that no
+        # longer holds the code would remove some other code for good
+        rows = self.resolve_code_rows(codes_list, verify_rows=True)
+        if not rows:
+            return set()
+        ranges = contiguous_row_ranges(rows.values())
+        if archive:
+            self.archive_row_ranges(ranges)
+        self.delete_row_ranges(ranges)
+
+        # Rows below each deleted one move up, so shift the row index rather
+        # than scanning the sheet again
+        deleted_rows = sorted(rows.values())
+        with self._lock:
+            self.rows = {
+                code: row - bisect_left(deleted_rows, row)
+                for code, row in self.rows.items() if code not in rows
+            }
+            if self.last_row is not None:
+                if self.last_code in rows:
+                    if self.rows:
+                        self.last_code, self.last_row = max(self.rows.items(), key=lambda item: item[1])
+                    else:
+                        self.last_row = 1
+                        self.last_code = HEADERS[0]
+                else:
+                    self.last_row -= bisect_left(deleted_rows, self.last_row)
+        return set(rows)
+
+    def archive_row_ranges(self, ranges):
+        """Append the rows in (first, last) ranges to the archive worksheet"""
+        archive_worksheet = self.archive_worksheet
+        if archive_worksheet is None:
+            raise RuntimeError(
+                "Can't archive codes: no archive worksheet is configured for this storage. "
+                "Pass archive_worksheet, or a connection with an archive_title."
+            )
+
+        values = []
+        for start in range(0, len(ranges), STATUS_RANGES_PER_READ):
+            chunk = ranges[start:start + STATUS_RANGES_PER_READ]
+            for block in self.worksheet.batch_get([f'A{first}:D{last}' for first, last in chunk]):
+                values.extend(block)
+        archived_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        archive_rows = [(list(row) + [''] * 4)[:4] + [archived_at] for row in values]
+
+        if not archive_worksheet.row_values(1):
+            archive_rows.insert(0, ARCHIVE_HEADERS)
+        archive_worksheet.append_rows(
+            archive_rows, value_input_option='USER_ENTERED', insert_data_option='INSERT_ROWS', table_range='A1'
+        )
+
+    def delete_row_ranges(self, ranges):
+        """Delete (first, last) row ranges in as few requests as possible"""
+        worksheet = self.worksheet
+        if len(ranges) == 1:
+            worksheet.delete_rows(*ranges[0])
+            return
+
+        # One request for every range, deleting from the bottom up so the
+        # row numbers of the ranges still to go stay valid
+        body = {
+            'requests': [
+                {
+                    'deleteDimension': {
+                        'range': {
+                            'sheetId': worksheet.id,
+                            'dimension': 'ROWS',
+                            'startIndex': first - 1,
+                            'endIndex': last
+                        }
+                    }
+                }
+                for first, last in sorted(ranges, reverse=True)
+            ]
+        }
+        request = lambda: worksheet.spreadsheet.batch_update(body)
+        if self.scheduler is not None:
+            # Deleting by row number twice would take out other codes
+            self.scheduler.write(request, idempotent=False)
+        else:
+            request()
+
+    def reserve_code_indices(self, count):
+        counter_worksheet = self.counter_worksheet
+        if counter_worksheet is None:
+            raise RuntimeError(
+                "Can't reserve code indices: no allocator worksheet is configured for this storage. "
+                "Pass counter_worksheet, or a connection with a counter_title (set code_key in the app)."
+            )
+        # Sheets has no atomic increment, but appends are applied one at a
+        # time. Each reservation appends its count below the base in B1, and
+        # its range starts at the sum of everything above it, so processes
+        # reserving at once always get ranges that don't overlap.
+        reserved_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # Unique to this call, so a row another reservation also landed on
+        # is never taken for ours
+        label = f"{RESERVED_LABEL} {reserved_at} {uuid.uuid4().hex}"
+        response = counter_worksheet.append_rows(
+            [[label, count]], value_input_option='RAW', table_range='A1'
+        )
+        row = appended_row(response)
+        values = counter_worksheet.get(f'A1:B{row}')
+        # Our label and count, read back, confirm the row is the one we appended
+        ours = values[-1] if len(values) == row else []
+        if len(ours) < 2 or ours[0] != label or str(ours[1]).strip() != str(count):
+            raise RuntimeError(f"Allocator row {row} doesn't hold the {count} codes just reserved")
+        return sum(int(cells[1]) for cells in values[:-1] if len(cells) > 1 and str(cells[1]).strip())
+
+
+class SQLiteStorage(CodeStorage):
+    """Codes stored in a local SQLite database"""
+
+    def __init__(self, path):
+        self.path = path
+        # One connection shared by every session thread, serialized by a lock
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS codes ('
+                ' code TEXT PRIMARY KEY,'
+                " deal TEXT NOT NULL DEFAULT '',"
+                ' redeemed INTEGER NOT NULL DEFAULT 0,'
+                " redeemed_at TEXT NOT NULL DEFAULT ''"
+                ')'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_codes_deal_redeemed ON codes (deal, redeemed)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_codes_redeemed ON codes (redeemed)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS archived_codes ('
+                'code TEXT NOT NULL, deal TEXT NOT NULL, redeemed INTEGER NOT NULL, redeemed_at TEXT NOT NULL, '
+                'archived_at TEXT NOT NULL)'
+            )
+
+    def load_codes(self):
+        codes = CompactCodeStore()
+        with self._lock:
+            for code, deal, redeemed, redeemed_at in self._conn.execute(
+                'SELECT code, deal, redeemed, redeemed_at FROM codes ORDER BY rowid'
+            ):
+                codes.add(code, deal, bool(redeemed), redeemed_at)
+        return codes
+
+    def save_codes_batch(self, codes_list, deal=''):
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN')
+                self._conn.executemany(
+                    'INSERT OR IGNORE INTO codes (code, deal) VALUES (?, ?)',
+                    ((str(code), str(deal)) for code in codes_list)
+                )
+
+    def update_code_status(self, code, redeemed, redeemed_at='', verify_row=True):
+        with self._lock:
+            cursor = self._conn.execute(
+                'UPDATE codes SET redeemed = ?, redeemed_at = ? WHERE code = ?',
+                (int(redeemed), redeemed_at, code)
+            )
+        return cursor.rowcount > 0
+
+    def update_codes_status(self, codes_list, redeemed, redeemed_at='', verify_rows=True):
+        codes_list = list(codes_list)
+        found = set()
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN')
+                # SQLite caps the number of bound parameters per statement
+                for start in range(0, len(codes_list), 500):
+                    chunk = codes_list[start:start + 500]
+                    placeholders = ', '.join('?' * len(chunk))
+                    found.update(code for (code,) in self._conn.execute(
+                        f'SELECT code FROM codes WHERE code IN ({placeholders})', chunk
+                    ))
+                    self._conn.execute(
+                        f'UPDATE codes SET redeemed = ?, redeemed_at = ? WHERE code IN ({placeholders})',
+                        [int(redeemed), redeemed_at, *chunk]
+                    )
+        return found
+
+    def read_statuses(self, codes_list, verify_rows=True):
+        codes_list = list(codes_list)
+        statuses = {}
+        with self._lock:
+            for start in range(0, len(codes_list), 500):
+                chunk = codes_list[start:start + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                for code, redeemed, redeemed_at in self._conn.execute(
+                    f'SELECT code, redeemed, redeemed_at FROM codes WHERE code IN ({placeholders})', chunk
+                ):
+                    statuses[code] = (bool(redeemed), redeemed_at)
+        return statuses
+
+    def write_redemptions(self, redemptions, verify_rows=True):
+        found = set()
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN')
+                for code, redeemed_at in redemptions.items():
+                    cursor = self._conn.execute(
+                        'UPDATE codes SET redeemed = 1, redeemed_at = ? WHERE code = ?', (redeemed_at, code)
+                    )
+                    if cursor.rowcount > 0:
+                        found.add(code)
+        return found
+
+    def redeem_code(self, code, redeemed_at, verify_row=True):
+        with self._lock:
+            # A single conditional UPDATE is atomic across processes too
+            cursor = self._conn.execute(
+                'UPDATE codes SET redeemed = 1, redeemed_at = ? WHERE code = ? AND redeemed = 0',
+                (redeemed_at, code)
+            )
+            if cursor.rowcount > 0:
+                return REDEEMED, redeemed_at
+            row = self._conn.execute('SELECT redeemed_at FROM codes WHERE code = ?', (code,)).fetchone()
+        if row is None:
+            return UNKNOWN_CODE, ''
+        return ALREADY_REDEEMED, row[0]
+
+    def delete_all_codes(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM codes')
+
+    def delete_codes(self, codes_list, archive=False):
+        codes_list = list(codes_list)
+        archived_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        found = set()
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN')
+                for start in range(0, len(codes_list), 500):
+                    chunk = codes_list[start:start + 500]
+                    placeholders = ', '.join('?' * len(chunk))
+                    found.update(code for (code,) in self._conn.execute(
+                        f'SELECT code FROM codes WHERE code IN ({placeholders})', chunk
+                    ))
+                    if archive:
+                        self._conn.execute(
+                            'INSERT INTO archived_codes (code, deal, redeemed, redeemed_at, archived_at) '
+                            f'SELECT code, deal, redeemed, redeemed_at, ? FROM codes WHERE code IN ({placeholders})',
+                            [archived_at, *chunk]
+                        )
+                    self._conn.execute(f'DELETE FROM codes WHERE code IN ({placeholders})', chunk)
+        return found
+
+    def reserve_code_indices(self, count):
+        with self._lock:
+            with self._conn:
+                # IMMEDIATE takes the write lock up front, so other processes
+                # sharing the database file cannot reserve the same range
+                self._conn.execute('BEGIN IMMEDIATE')
+                row = self._conn.execute("SELECT value FROM meta WHERE key = 'next_code_index'").fetchone()
+                start = row[0] if row else 0
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('next_code_index', ?)",
+                    (start + count,)
+                )
+        return start
+
+
+class FakeCell:
+    """Stand-in for gspread.Cell"""
+
+    def __init__(self, row, col, value):
+        self.row = row
+        self.col = col
+        self.value = value
+
+
+class FakeSpreadsheet:
+    """Stand-in for the gspread.Spreadsheet that owns a FakeWorksheet"""
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+    def get_lastUpdateTime(self):
+        # Any value that changes on every write will do
+        return str(self.worksheet.modified)
+
+    def batch_update(self, body):
+        # Only the row deletions SheetsStorage sends are supported. As with
+        # gspread, the worksheet's row_count isn't updated by this request.
+        row_count = self.worksheet.row_count
+        for request in body['requests']:
+            row_range = request['deleteDimension']['range']
+            self.worksheet.delete_rows(row_range['startIndex'] + 1, row_range['endIndex'])
+        self.worksheet.row_count = row_count
+
+
+class FakeWorksheet:
+    """In-memory copy of the parts of the gspread Worksheet API the app uses"""
+
+    def __init__(self, rows=None, row_count=1000):
+        self.rows = [list(row) for row in rows] if rows else []
+        # Size of the grid, which like a real sheet starts at 1000 rows
+        self.row_count = max(row_count, len(self.rows))
+        # Bumped on every write, reported as the spreadsheet's update time
+        self.modified = 0
+        self.id = 0
+        self.spreadsheet = FakeSpreadsheet(self)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse_a1(label):
+        # The row may be left off the end of a range, as in 'A5:D'
+        match = re.fullmatch(r'([A-Z]+)(\d*)', label.upper())
+        if not match:
+            raise ValueError(f"Invalid cell label: {label}")
+        col = 0
+        for char in match.group(1):
+            col = col * 26 + ord(char) - ord('A') + 1
+        return int(match.group(2)) if match.group(2) else None, col
+
+    def _parse_range(self, range_name):
+        start, _, end = range_name.partition(':')
+        start_row, start_col = self._parse_a1(start)
+        end_row, end_col = self._parse_a1(end) if end else (start_row, start_col)
+        if end_row is None:
+            end_row = len(self.rows)
+        return start_row, start_col, end_row, end_col
+
+    def _write(self, row, col, values):
+        self.modified += 1
+        while len(self.rows) < row:
+            self.rows.append([])
+        target = self.rows[row - 1]
+        while len(target) < col - 1 + len(values):
+            target.append('')
+        for offset, value in enumerate(values):
+            target[col - 1 + offset] = '' if value is None else str(value)
+
+    @staticmethod
+    def _trim(values):
+        # gspread drops trailing empty cells and rows from what it returns
+        values = [list(row) for row in values]
+        for row in values:
+            while row and row[-1] == '':
+                row.pop()
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def row_values(self, row):
+        with self._lock:
+            values = list(self.rows[row - 1]) if row <= len(self.rows) else []
+        while values and values[-1] == '':
+            values.pop()
+        return values
+
+    def col_values(self, col):
+        with self._lock:
+            values = [row[col - 1] if len(row) >= col else '' for row in self.rows]
+        while values and values[-1] == '':
+            values.pop()
+        return values
+
+    def get_all_values(self):
+        with self._lock:
+            width = max((len(row) for row in self.rows), default=0)
+            # gspread pads every row to the same width
+            return [list(row) + [''] * (width - len(row)) for row in self._trim(self.rows)]
+
+    def get(self, range_name):
+        start_row, start_col, end_row, end_col = self._parse_range(range_name)
+        with self._lock:
+            values = []
+            for row in range(start_row, end_row + 1):
+                source = self.rows[row - 1] if row <= len(self.rows) else []
+                values.append([source[col - 1] if col <= len(source) else '' for col in range(start_col, end_col + 1)])
+        return self._trim(values)
+
+    def batch_get(self, ranges):
+        return [self.get(range_name) for range_name in ranges]
+
+    def acell(self, label):
+        row, col = self._parse_a1(label)
+        with self._lock:
+            source = self.rows[row - 1] if row <= len(self.rows) else []
+            value = source[col - 1] if col <= len(source) and source[col - 1] != '' else None
+        return FakeCell(row, col, value)
+
+    def update(self, values=None, range_name=None, value_input_option='RAW'):
+        start_row, start_col, _, _ = self._parse_range(range_name)
+        if start_row + len(values) - 1 > self.row_count:
+            raise ValueError(f"Range ({range_name}) exceeds grid limits. Max rows: {self.row_count}")
+        with self._lock:
+            for offset, row in enumerate(values):
+                self._write(start_row + offset, start_col, row)
+
+    def batch_update(self, data, value_input_option='RAW'):
+        for item in data:
+            self.update(values=item['values'], range_name=item['range'], value_input_option=value_input_option)
+
+    def update_cell(self, row, col, value):
+        with self._lock:
+            self._write(row, col, [value])
+
+    def append_row(self, values, value_input_option='RAW'):
+        self.append_rows([values], value_input_option)
+
+    def append_rows(self, values, value_input_option='RAW', insert_data_option=None, table_range=None):
+        with self._lock:
+            # Sheets appends after the table starting at A1, which ends at
+            # the first blank row
+            last = 0
+            while last < len(self.rows) and any(cell != '' for cell in self.rows[last]):
+                last += 1
+            if insert_data_option == 'INSERT_ROWS':
+                # Rows below the table are pushed down rather than overwritten
+                self.rows[last:last] = [[] for _ in values]
+                self.row_count += len(values)
+            for offset, row in enumerate(values):
+                self._write(last + 1 + offset, 1, row)
+            self.row_count = max(self.row_count, len(self.rows))
+        return {'updates': {'updatedRange': f"Sheet1!A{last + 1}:D{last + len(values)}"}}
+
+    def add_rows(self, rows):
+        with self._lock:
+            self.row_count += rows
+
+    def resize(self, rows=None, cols=None):
+        with self._lock:
+            if rows is not None:
+                del self.rows[rows:]
+                self.row_count = rows
+
+    def delete_rows(self, start_index, end_index=None):
+        if end_index is None:
+            end_index = start_index
+        with self._lock:
+            del self.rows[start_index - 1:end_index]
+            self.row_count -= end_index - start_index + 1
+            self.modified += 1
@@ -0,0 +1,72 @@
+from code_index import REDEEMED
+from journal import RedemptionJournal, JournaledStorage
+from storage import SheetsStorage, FakeWorksheet, HEADERS
+
+CODE = 'ABC123XYZ'
+
+# Long enough that the background flusher never runs during a test
+FLUSH_INTERVAL = 3600
+
+
+def make_worksheet():
+    return FakeWorksheet([HEADERS, [CODE, 'Deal', 'FALSE', ''], ['OTHER1234', 'Deal', 'FALSE', '']])
+
+
+def open_journaled(worksheet, path):
+    storage = SheetsStorage(worksheet)
+    storage.load_codes()
+    return JournaledStorage(
+        storage, RedemptionJournal(str(path)), is_fresh=lambda: True, flush_interval=FLUSH_INTERVAL
+    )
+
+
+def test_pending_redemptions_are_replayed_after_a_restart(tmp_path):
+    worksheet = make_worksheet()
+    path = tmp_path / 'redemptions.db'
+    storage = open_journaled(worksheet, path)
+
+    assert storage.redeem_code(CODE, '2026-01-01 12:00:00', verify_row=False) == (REDEEMED, '2026-01-01 12:00:00')
+    assert worksheet.rows[1][2] == 'FALSE'
+
+    # The process dies before the flush - a new one opens the same journal
+    restarted = open_journaled(worksheet, path)
+    assert len(restarted.journal) == 1
+    assert restarted.load_codes()[CODE]['redeemed']
+
+    assert restarted.flush() == 1
+    assert worksheet.rows[1][2:] == ['TRUE', '2026-01-01 12:00:00']
+    assert len(restarted.journal) == 0
+    assert restarted.flushed == 1
+    restarted.close()
+
+
+def test_flush_records_conflicts_instead_of_overwriting(tmp_path):
+    worksheet = make_worksheet()
+    storage = open_journaled(worksheet, tmp_path / 'redemptions.db')
+    storage.redeem_code(CODE, '2026-01-01 12:00:00', verify_row=False)
+
+    # Another process redeemed the code in the sheet meanwhile
+    worksheet.update(values=[['TRUE', '2026-01-01 11:59:00']], range_name='C2:D2')
+
+    assert storage.flush() == 1
+    assert worksheet.rows[1][2:] == ['TRUE', '2026-01-01 11:59:00']
+    conflicts = storage.journal.conflicts()
+    assert [(c['code'], c['redeemed_at'], c['stored_redeemed_at']) for c in conflicts] == [
+        (CODE, '2026-01-01 12:00:00', '2026-01-01 11:59:00')
+    ]
+    assert len(storage.journal) == 0
+    storage.close()
+
+
+def test_status_update_supersedes_pending_redemption(tmp_path):
+    worksheet = make_worksheet()
+    storage = open_journaled(worksheet, tmp_path / 'redemptions.db')
+    storage.redeem_code(CODE, '2026-01-01 12:00:00', verify_row=False)
+
+    # An admin marks the code available again before the flush
+    assert storage.update_codes_status([CODE], False) == {CODE}
+    assert storage.journal.pending_for(CODE) is None
+
+    assert storage.flush() == 0
+    assert worksheet.rows[1][2:] == ['FALSE', '']
+    storage.close()
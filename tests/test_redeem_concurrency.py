@@ -0,0 +1,81 @@
+import threading
+import time
+
+from code_index import CodeIndex, REDEEMED, ALREADY_REDEEMED
+from shared_cache import SharedChangeLog
+from storage import SheetsStorage, FakeWorksheet, HEADERS
+
+REDEEMERS = 16
+CODE = 'ABC123XYZ'
+
+
+# Seconds every sheet read takes, so redeemers overlap the way they would over the network
+READ_LATENCY = 0.01
+
+
+class SlowWorksheet(FakeWorksheet):
+    """FakeWorksheet whose reads take a while, opening the gap between checking a code and writing it"""
+
+    def get(self, range_name):
+        values = super().get(range_name)
+        time.sleep(READ_LATENCY)
+        return values
+
+
+def make_worksheet():
+    return SlowWorksheet([HEADERS, [CODE, 'Deal', 'FALSE', ''], ['OTHER1234', 'Deal', 'FALSE', '']])
+
+
+def redeem_at_once(redeemers):
+    """Run every (index, storage) redeemer at the same moment, returning their outcomes"""
+    barrier = threading.Barrier(len(redeemers))
+    outcomes = [None] * len(redeemers)
+
+    def redeem(position, index, storage):
+        barrier.wait()
+        outcomes[position] = index.redeem(storage, CODE, f'2026-01-01 12:00:{position:02d}')
+
+    threads = [
+        threading.Thread(target=redeem, args=(position, index, storage))
+        for position, (index, storage) in enumerate(redeemers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def redeemed_rows(worksheet):
+    return [row for row in worksheet.rows[1:] if row[2] == 'TRUE']
+
+
+def test_one_process_redeems_a_code_once():
+    worksheet = make_worksheet()
+    storage = SheetsStorage(worksheet)
+    index = CodeIndex()
+    index.get_codes(storage.load_codes)
+
+    outcomes = redeem_at_once([(index, storage)] * REDEEMERS)
+
+    assert outcomes.count(REDEEMED) == 1
+    assert outcomes.count(ALREADY_REDEEMED) == REDEEMERS - 1
+    assert len(redeemed_rows(worksheet)) == 1
+    assert index.codes[CODE]['redeemed']
+
+
+def test_processes_sharing_a_change_log_redeem_a_code_once(tmp_path):
+    worksheet = make_worksheet()
+    redeemers = []
+    for _ in range(REDEEMERS):
+        # Each redeemer stands in for a separate process with its own index
+        storage = SheetsStorage(worksheet)
+        index = CodeIndex(change_log=SharedChangeLog(str(tmp_path / 'shared.db')))
+        index.get_codes(storage.load_codes)
+        redeemers.append((index, storage))
+
+    outcomes = redeem_at_once(redeemers)
+
+    assert outcomes.count(REDEEMED) == 1
+    assert outcomes.count(ALREADY_REDEEMED) == REDEEMERS - 1
+    assert len(redeemed_rows(worksheet)) == 1
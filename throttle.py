@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import OrderedDict
+
+from sheets_scheduler import TokenBucket
+
+# Checks and redemptions one client may attempt a minute, in bursts of up to
+# the same number
+ATTEMPTS_PER_MINUTE = 60
+
+# Unknown codes one client may try a minute. A client over this is refused
+# until it would have earned another try.
+INVALID_ATTEMPTS_PER_MINUTE = 10
+
+# Clients tracked at once - the least recently seen are forgotten first
+MAX_CLIENTS = 10_000
+
+
+class _Client:
+    def __init__(self, attempts_per_minute, invalid_per_minute):
+        self.attempts = TokenBucket(attempts_per_minute)
+        self.invalid = TokenBucket(invalid_per_minute)
+        self.blocked_until = 0.0
+
+
+class ClientThrottle:
+    """Per-client limits on code checks and redemptions, against guessing codes
+
+    Every attempt takes a token from the client's attempt bucket, and every
+    unknown code one from its invalid bucket. Once either runs dry the
+    client is refused until it refills, without the code being looked up
+    at all. A client is any hashable key, e.g. a session ID or an
+    IP address.
+    """
+
+    def __init__(self, attempts_per_minute=ATTEMPTS_PER_MINUTE, invalid_per_minute=INVALID_ATTEMPTS_PER_MINUTE,
+                 max_clients=MAX_CLIENTS):
+        self.attempts_per_minute = attempts_per_minute
+        self.invalid_per_minute = invalid_per_minute
+        self.max_clients = max_clients
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {
+            'allowed': 0,
+            'throttled': 0,
+            'rejected': 0
+        }
+
+    def _client(self, key):
+        client = self._clients.get(key)
+        if client is None:
+            client = self._clients[key] = _Client(self.attempts_per_minute, self.invalid_per_minute)
+            if len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        else:
+            self._clients.move_to_end(key)
+        return client
+
+    def check(self, *keys):
+        """Take an attempt for each client key, returning 0 if allowed or the seconds to wait"""
+        now = time.monotonic()
+        with self._lock:
+            clients = [self._client(key) for key in keys if key is not None]
+            wait = max([client.blocked_until - now for client in clients] + [0])
+            if not wait:
+                for client in clients:
+                    wait = max(wait, client.attempts.try_acquire())
+            self.counters['throttled' if wait else 'allowed'] += 1
+        return wait
+
+    def reject(self, *keys):
+        """Charge each client key for trying a code that doesn't exist"""
+        now = time.monotonic()
+        with self._lock:
+            self.counters['rejected'] += 1
+            for key in keys:
+                if key is None:
+                    continue
+                client = self._client(key)
+                wait = client.invalid.try_acquire()
+                if wait:
+                    client.blocked_until = max(client.blocked_until, now + wait)
+
+    def stats(self):
+        """Get the attempt counters plus how many clients are being tracked"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats['clients'] = len(self._clients)
+        return stats
+
+    def reset_counters(self):
+        """Zero the counters, keeping every client's allowance as it is"""
+        with self._lock:
+            for name in self.counters:
+                self.counters[name] = 0